@@ -0,0 +1,5 @@
+"""
+Microbenchmarks for the pure-CPU helpers run on every request
+
+Run them with `python -m benchmarks`, see `python -m benchmarks --help`.
+"""
@@ -0,0 +1,93 @@
+"""
+Runs the benchmarks and compares them with the stored baseline
+
+    python -m benchmarks                  # compare with benchmarks/baseline.json
+    python -m benchmarks --save           # record a new baseline
+    python -m benchmarks -k split         # only the cases with "split" in their name
+
+Every case is timed as the best of several repeats. Timings are scaled by a
+fixed pure-Python calibration loop, so a baseline recorded on one machine stays
+meaningful on another. The run fails when a case is slower than its baseline
+by more than the threshold.
+"""
+import sys
+import json
+import timeit
+import argparse
+from pathlib import Path
+
+from benchmarks.cases import CASES
+
+BASELINE = Path(__file__).with_name("baseline.json")
+CALIBRATION = "calibration"
+
+
+def _calibration() -> None:
+    total = 0
+    for i in range(20000):
+        total += i * i % 7
+    "".join(str(i) for i in range(2000))
+
+
+def measure(fn, repeat: int, min_time: float) -> float:
+    timer = timeit.Timer(fn)
+    number, elapsed = timer.autorange()
+    # at least min_time per repeat so short cases are not dominated by timer noise
+    number = max(1, int(number * min_time / max(elapsed, 1e-9)))
+    return min(timer.repeat(repeat=repeat, number=number)) / number
+
+
+def _format(seconds: float) -> str:
+    for unit, scale in (("s", 1), ("ms", 1e-3), ("us", 1e-6)):
+        if seconds >= scale:
+            return f"{seconds / scale:.2f}{unit}"
+    return f"{seconds / 1e-9:.0f}ns"
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m benchmarks", description=__doc__.split("\n\n")[0])
+    parser.add_argument("-k", dest="filter", default="", help="only run cases whose name contains this")
+    parser.add_argument("--save", action="store_true", help="store the results as the new baseline")
+    parser.add_argument("--threshold", type=float, default=1.5, help="slowdown ratio that counts as a regression")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--min-time", type=float, default=0.2, help="seconds spent in every repeat")
+    parser.add_argument("--baseline", type=Path, default=BASELINE)
+    args = parser.parse_args(argv)
+
+    baseline = json.loads(args.baseline.read_text()) if args.baseline.exists() else {}
+    calibration = measure(_calibration, args.repeat, args.min_time)
+    # how much faster or slower this machine is than the one the baseline was recorded on
+    scale = calibration / baseline[CALIBRATION] if CALIBRATION in baseline else 1.0
+
+    results, regressions = {CALIBRATION: calibration}, []
+    print(f"{'case':<28} {'time':>10} {'baseline':>10} {'ratio':>7}")
+    for name, build in CASES.items():
+        if args.filter not in name:
+            continue
+        fn = build()
+        seconds = results[name] = measure(fn, args.repeat, args.min_time)
+        line = f"{name:<28} {_format(seconds):>10}"
+        if name in baseline:
+            expected = baseline[name] * scale
+            ratio = seconds / expected
+            line += f" {_format(expected):>10} {ratio:>6.2f}x"
+            if ratio > args.threshold:
+                regressions.append(name)
+                line += "  REGRESSION"
+        # anything else a case wants to report, such as how many messages a splitter made
+        if getattr(fn, "note", None):
+            line += f"  ({fn.note})"
+        print(line)
+
+    if args.save:
+        args.baseline.write_text(json.dumps({**baseline, **results}, indent=2, sort_keys=True) + "\n")
+        print(f"Saved baseline to {args.baseline}")
+        return 0
+    if regressions:
+        print(f"{len(regressions)} case(s) slower than {args.threshold}x their baseline: {', '.join(regressions)}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
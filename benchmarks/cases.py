@@ -0,0 +1,160 @@
+"""
+Benchmark cases
+
+Every case is a function returning the callable to time, so building the
+inputs is not part of the measurement. Coroutines run to completion on one
+event loop kept for the whole run, against the load-test fakes of Discord.
+"""
+import base64
+import random
+import asyncio
+from types import SimpleNamespace
+from datetime import datetime, timedelta
+
+from loadtest.fakes import FakeChannel, FakeGuild, FakeInteraction, FakeUser
+from utils import message_utils
+from src import art, responses
+from src.outbound import Outbox
+
+CASES = {}
+
+
+# the inputs are seeded by case name, so they are the same however many cases run
+def case(name: str):
+    def register(fn):
+        def build():
+            _random.seed(name)
+            return fn()
+        CASES[name] = build
+        return fn
+    return register
+
+
+_loop = asyncio.new_event_loop()
+run_sync = _loop.run_until_complete
+
+
+_client = SimpleNamespace(outbox=Outbox())
+_guild = FakeGuild()
+_user = FakeUser("bench")
+_random = random.Random()
+
+
+def _prose(chars: int) -> str:
+    words = []
+    while sum(len(word) + 1 for word in words) < chars:
+        words.append("".join(_random.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(_random.randint(2, 10))))
+        if _random.random() < 0.08:
+            words[-1] += ".\n\n" if _random.random() < 0.3 else ".\n"
+    return " ".join(words)[:chars]
+
+
+def _code_heavy(chars: int) -> str:
+    parts = []
+    while sum(map(len, parts)) < chars:
+        parts.append(_prose(300))
+        lines = [f"    value_{i} = compute({i}, 'argument')  # step {i}" for i in range(_random.randint(10, 80))]
+        parts.append("```python\ndef handler():\n" + "\n".join(lines) + "\n```")
+    return "\n\n".join(parts)[:chars]
+
+
+def _split(text: str):
+    def run():
+        interaction = FakeInteraction(_user, FakeChannel(_guild))
+        run_sync(message_utils.send_split_message(_client, text, interaction))
+    return run
+
+
+@case("split_message_short")
+def split_short():
+    return _split(_prose(1500))
+
+
+@case("split_message_prose_20k")
+def split_prose():
+    return _split(_prose(20000))
+
+
+@case("split_message_code_20k")
+def split_code():
+    return _split(_code_heavy(20000))
+
+
+# the splitter send_split_message used before split_message, kept to compare against
+def legacy_split(response: str, char_limit: int = 1900) -> list[str]:
+    if len(response) <= char_limit:
+        return [response]
+    chunks, is_code_block = [], False
+    for part in response.split("```"):
+        for j in range(0, len(part), char_limit):
+            chunks.append(f"```{part[j:j+char_limit]}```" if is_code_block else part[j:j+char_limit])
+        is_code_block = not is_code_block
+    return chunks
+
+
+def _chunk(splitter, text: str):
+    def run():
+        return splitter(text)
+    run.note = f"{len(splitter(text))} messages"
+    return run
+
+
+@case("chunk_legacy_prose_20k")
+def chunk_legacy_prose():
+    return _chunk(legacy_split, _prose(20000))
+
+
+@case("chunk_prose_20k")
+def chunk_prose():
+    return _chunk(message_utils.split_message, _prose(20000))
+
+
+@case("chunk_legacy_code_20k")
+def chunk_legacy_code():
+    return _chunk(legacy_split, _code_heavy(20000))
+
+
+@case("chunk_code_20k")
+def chunk_code():
+    return _chunk(message_utils.split_message, _code_heavy(20000))
+
+
+@case("response_with_images")
+def response_with_images():
+    text = " ".join(f"{_prose(800)} [Image of a thing number {i}]" for i in range(5))
+    response = {"content": text, "images": [f"https://images.example/{i}.png" for i in range(5)]}
+
+    def run():
+        interaction = FakeInteraction(_user, FakeChannel(_guild))
+        run_sync(message_utils.send_response_with_images(_client, response, interaction))
+    return run
+
+
+@case("preference_prompt")
+def preference_prompt():
+    user = {"username": "bench", "preferences": [f"preference {i}" for i in range(10)]}
+    return lambda: responses.preference_prompt(user, "How do I write a fast tokenizer?")
+
+
+@case("user_table_500")
+def user_table():
+    start = datetime(2023, 1, 1)
+    users = [{"username": f"user{i}#{i:04d}", "register_date": start + timedelta(hours=i)} for i in range(500)]
+    return lambda: message_utils.user_table(users)
+
+
+def _convert(amount: int):
+    # roughly the size of a compressed 1024x1024 PNG
+    image = base64.b64encode(_random.randbytes(1_500_000)).decode("ascii")
+    response = {"data": [{"b64_json": image} for _ in range(amount)]}
+    return lambda: art.convert(response)
+
+
+@case("art_convert_1")
+def convert_1():
+    return _convert(1)
+
+
+@case("art_convert_10")
+def convert_10():
+    return _convert(10)
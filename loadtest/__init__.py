@@ -0,0 +1,7 @@
+"""
+Offline load test for the bot
+
+Drives the real client and slash command handlers with simulated Discord
+interactions and messages, against a local stand-in for the OpenAI API and the
+in-memory database. Run it with `python -m loadtest --help`.
+"""
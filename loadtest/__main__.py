@@ -0,0 +1,234 @@
+"""
+Offline load test, e.g.
+
+    python -m loadtest --requests 1000 --concurrency 100 --mix chat=0.8,draw=0.05,replyall=0.15
+
+`concurrency` simulated users each send a request, wait for the answer and send
+the next one until `requests` have been sent. /chat and /draw go through the
+registered slash command callbacks, replyall messages through the same
+enqueue_message call on_message makes.
+"""
+import os
+import sys
+import time
+import random
+import asyncio
+import argparse
+from collections import Counter, defaultdict
+
+from loadtest.fakes import FakeChannel, FakeGuild, FakeInteraction, FakeMessage, FakeUser
+from loadtest.fake_openai import FakeOpenAI
+
+
+def parse_mix(text: str) -> dict:
+    mix = {}
+    for part in text.split(","):
+        kind, _, weight = part.partition("=")
+        if kind not in ("chat", "draw", "replyall"):
+            raise argparse.ArgumentTypeError(f"unknown request kind {kind!r}")
+        mix[kind] = float(weight or 1)
+    return mix
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog="python -m loadtest", description="Offline load test for the bot")
+    parser.add_argument("--requests", type=int, default=500, help="total requests to send")
+    parser.add_argument("--concurrency", type=int, default=50, help="simulated users sending at the same time")
+    parser.add_argument("--users", type=int, default=200, help="distinct Discord users")
+    parser.add_argument("--channels", type=int, default=10, help="distinct channels")
+    parser.add_argument("--mix", type=parse_mix, default="chat=0.8,draw=0.05,replyall=0.15",
+                        help="weights of /chat, /draw and replyall traffic")
+    parser.add_argument("--latency", type=float, default=0.5, help="seconds until the fake completion answers")
+    parser.add_argument("--jitter", type=float, default=0.2, help="relative jitter on every fake latency")
+    parser.add_argument("--answer-words", type=int, default=120, help="length of every fake answer")
+    parser.add_argument("--image-latency", type=float, default=2.0, help="seconds until the fake image API answers")
+    parser.add_argument("--discord-latency", type=float, default=0.05, help="seconds every fake Discord call takes")
+    parser.add_argument("--stream", action=argparse.BooleanOptionalAction, default=True, help="stream answers into Discord")
+    parser.add_argument("--registered", type=float, default=0.5, help="fraction of users registered with preferences")
+    parser.add_argument("--workers", type=int, help="chat workers, CHAT_WORKERS by default")
+    parser.add_argument("--rate-limits", action="store_true", help="keep the per-user and per-channel rate limits")
+    parser.add_argument("--metrics", action="store_true", help="also print the bot's own stage metrics")
+    parser.add_argument("--seed", type=int, default=0)
+    return parser.parse_args(argv)
+
+
+def configure(args: argparse.Namespace) -> None:
+    # these decide whether anything leaves the machine, so they are not taken from .env
+    os.environ["CHAT_MODEL"] = "OFFICIAL"
+    os.environ["OFFICIAL_BACKEND"] = "native"
+    os.environ["MONGO_BACKEND"] = "memory"
+    os.environ["OPENAI_API_KEY"] = "loadtest"
+    os.environ["DISCORD_CHANNEL_ID"] = ""
+    os.environ.pop("METRICS_PORT", None)
+    os.environ["STREAM_RESPONSES"] = str(args.stream)
+    os.environ.setdefault("GPT_ENGINE", "gpt-3.5-turbo")
+    os.environ.setdefault("REPLYING_ALL", "False")
+    if args.workers:
+        os.environ["CHAT_WORKERS"] = str(args.workers)
+    if not args.rate_limits:
+        os.environ["CHAT_USER_RATE"] = "0"
+        os.environ["CHAT_CHANNEL_RATE"] = "0"
+        os.environ["CHAT_MAX_IN_FLIGHT"] = str(args.requests)
+        os.environ["CHAT_MAX_QUEUE"] = str(args.requests)
+
+
+def percentile(values: list[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+class LoadTest:
+    def __init__(self, args: argparse.Namespace, client, repository) -> None:
+        self.args = args
+        self.client = client
+        self.repository = repository
+        self.random = random.Random(args.seed)
+        self.guild = FakeGuild()
+        self.users = [FakeUser(f"user{i}") for i in range(args.users)]
+        self.channels = [FakeChannel(self.guild, args.discord_latency) for _ in range(args.channels)]
+        self.kinds, self.weights = zip(*args.mix.items())
+        self.latencies = defaultdict(list)
+        self.queue_waits = []
+        self.outcomes = Counter()
+        # id of the queued interaction or message -> future resolved once it has been answered
+        self._answered: dict[int, asyncio.Future] = {}
+        self._sent = 0
+
+        handler = client.dispatcher.handler
+
+        async def traced(request):
+            try:
+                await handler(request)
+            finally:
+                future = self._answered.pop(id(request.message), None)
+                if future and not future.done():
+                    future.set_result(request.started_at - request.enqueued_at)
+
+        client.dispatcher.handler = traced
+
+    async def register_users(self) -> None:
+        for user in self.random.sample(self.users, int(len(self.users) * self.args.registered)):
+            await self.repository.register_user({
+                "username": str(user),
+                "major": "loadtest",
+                "preferences": ["short answers", "examples"],
+                "register_date": None,
+            })
+
+    async def _chat(self, user: FakeUser, channel: FakeChannel) -> bool:
+        interaction = FakeInteraction(user, channel)
+        answered = self._answered[id(interaction)] = asyncio.get_running_loop().create_future()
+        command = self.client.tree.get_command("chat")
+        await command.callback(interaction, message=f"question {self._sent} from {user}")
+        if not interaction.response.deferred:
+            self._answered.pop(id(interaction), None)
+            return False
+        self.queue_waits.append(await answered)
+        return True
+
+    async def _replyall(self, user: FakeUser, channel: FakeChannel) -> bool:
+        message = FakeMessage(channel, f"message {self._sent} from {user}", author=user)
+        answered = self._answered[id(message)] = asyncio.get_running_loop().create_future()
+        await self.client.enqueue_message(message, message.content)
+        if message.reactions:
+            self._answered.pop(id(message), None)
+            return False
+        self.queue_waits.append(await answered)
+        return True
+
+    async def _draw(self, user: FakeUser, channel: FakeChannel) -> bool:
+        interaction = FakeInteraction(user, channel)
+        command = self.client.tree.get_command("draw")
+        await command.callback(interaction, prompt=f"picture {self._sent}", amount=self.random.randint(1, 4))
+        return not any(reply and "**WARN" in reply for reply in interaction.replies)
+
+    async def _user(self) -> None:
+        while self._sent < self.args.requests:
+            self._sent += 1
+            kind = self.random.choices(self.kinds, self.weights)[0]
+            user, channel = self.random.choice(self.users), self.random.choice(self.channels)
+            started = time.monotonic()
+            try:
+                accepted = await getattr(self, f"_{kind}")(user, channel)
+            except Exception as e:
+                self.outcomes[f"{kind}_failed"] += 1
+                print(f"{kind} failed: {e!r}", file=sys.stderr)
+                continue
+            if accepted:
+                self.latencies[kind].append(time.monotonic() - started)
+                self.outcomes[f"{kind}_ok"] += 1
+            else:
+                self.outcomes[f"{kind}_rejected"] += 1
+
+    async def run(self) -> float:
+        started = time.monotonic()
+        await asyncio.gather(*(self._user() for _ in range(self.args.concurrency)))
+        return time.monotonic() - started
+
+    def report(self, elapsed: float, fake: FakeOpenAI) -> str:
+        done = sum(len(values) for values in self.latencies.values())
+        lines = [
+            f"requests: {self._sent} in {elapsed:.2f}s, {done / elapsed:.1f} answered/s",
+            f"concurrency: {self.args.concurrency}, workers: {self.client.dispatcher.workers}, "
+            f"stream: {self.args.stream}, fake latency: {self.args.latency}s",
+            f"upstream calls: {fake.chat_requests} chat, {fake.image_requests} image",
+            "",
+            f"{'kind':<10} {'count':>6} {'p50':>8} {'p95':>8} {'p99':>8} {'max':>8}",
+        ]
+        rows = list(self.latencies.items()) + [("queue", self.queue_waits)]
+        for kind, values in rows:
+            lines.append(
+                f"{kind:<10} {len(values):>6} {percentile(values, 0.5):>7.3f}s {percentile(values, 0.95):>7.3f}s "
+                f"{percentile(values, 0.99):>7.3f}s {max(values, default=0):>7.3f}s")
+        lines.append("")
+        lines.append("outcomes: " + ", ".join(f"{name}={count}" for name, count in sorted(self.outcomes.items())))
+        lines.append("admission: " + ", ".join(f"{name}={count}" for name, count in self.client.admission.stats().items()))
+        lines.append("outbound: " + ", ".join(f"{name}={count}" for name, count in self.client.outbox.stats().items()))
+        if self.client.in_flight:
+            lines.append(f"coalesced: {self.client.in_flight.saved}")
+        return "\n".join(lines)
+
+
+async def main(args: argparse.Namespace) -> None:
+    fake = FakeOpenAI(args.latency, args.jitter, args.answer_words, image_latency=args.image_latency)
+    os.environ["OPENAI_BASE_URL"] = await fake.start()
+    configure(args)
+
+    # imported late, the client reads its configuration when it is created
+    import openai
+    from src import bot, openai_chat
+    from src.aclient import client
+    from src.metrics import metrics
+
+    openai.api_base = os.environ["OPENAI_BASE_URL"]
+    bot.setup_bot()
+    await client.repository.migrate()
+    test = LoadTest(args, client, client.repository)
+    await test.register_users()
+    client.interaction_log.start()
+    if client.history:
+        client.history.start()
+    client.dispatcher.start()
+    try:
+        elapsed = await test.run()
+    finally:
+        await client.dispatcher.stop()
+        await client.interaction_log.close()
+        if client.history:
+            await client.history.close()
+        client.repository.close()
+        await openai_chat.close()
+        await fake.stop()
+
+    print(test.report(elapsed, fake))
+    if args.metrics:
+        print()
+        print(metrics.summary())
+
+
+if __name__ == "__main__":
+    arguments = parse_args()
+    random.seed(arguments.seed)
+    asyncio.run(main(arguments))
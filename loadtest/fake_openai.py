@@ -0,0 +1,96 @@
+"""
+Local stand-in for the parts of the OpenAI API the bot calls
+
+Chat completions answer after a configurable latency, as one JSON body or as
+server-sent events when the request asks for a stream. Image generations
+return a tiny PNG for every image asked for.
+"""
+import json
+import time
+import random
+import asyncio
+import base64
+
+from aiohttp import web
+
+# 1x1 transparent PNG
+PNG = base64.b64encode(bytes.fromhex(
+    "89504e470d0a1a0a0000000d4948445200000001000000010806000000"
+    "1f15c4890000000d49444154789c6360000002000100ffff03000006000557bfabd40000000049454e44ae426082"
+)).decode("ascii")
+
+
+class FakeOpenAI:
+    def __init__(self, latency: float = 0.5, jitter: float = 0.2, answer_words: int = 120,
+                 chunk_delay: float = 0.02, image_latency: float = 2.0) -> None:
+        self.latency = latency
+        self.jitter = jitter
+        self.answer_words = answer_words
+        # pause between streamed chunks, the first one arrives after `latency`
+        self.chunk_delay = chunk_delay
+        self.image_latency = image_latency
+        self.chat_requests = 0
+        self.image_requests = 0
+        self._runner = None
+        self.url = None
+
+    def _delay(self, base: float) -> float:
+        return max(0.0, base + random.uniform(-self.jitter, self.jitter) * base)
+
+    def _answer(self, messages: list[dict]) -> str:
+        prompt = messages[-1]["content"] if messages else ""
+        words = [f"word{i}" for i in range(self.answer_words)]
+        return f"You said {len(prompt)} characters. " + " ".join(words)
+
+    async def chat(self, request: web.Request) -> web.StreamResponse:
+        self.chat_requests += 1
+        body = await request.json()
+        answer = self._answer(body.get("messages", []))
+        await asyncio.sleep(self._delay(self.latency))
+
+        if not body.get("stream"):
+            return web.json_response({
+                "id": f"chatcmpl-{self.chat_requests}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": body.get("model"),
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": answer}, "finish_reason": "stop"}],
+            })
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        words = answer.split(" ")
+        for start in range(0, len(words), 8):
+            chunk = " ".join(words[start:start + 8]) + " "
+            data = {"choices": [{"index": 0, "delta": {"content": chunk}, "finish_reason": None}]}
+            await response.write(f"data: {json.dumps(data)}\n\n".encode("utf-8"))
+            await asyncio.sleep(self.chunk_delay)
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+    async def images(self, request: web.Request) -> web.Response:
+        self.image_requests += 1
+        body = await request.json()
+        await asyncio.sleep(self._delay(self.image_latency))
+        return web.json_response({
+            "created": int(time.time()),
+            "data": [{"b64_json": PNG} for _ in range(int(body.get("n", 1)))],
+        })
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        app = web.Application()
+        app.router.add_post("/v1/chat/completions", self.chat)
+        app.router.add_post("/v1/images/generations", self.images)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        # port 0 picks a free port, read back the one we got
+        port = self._runner.addresses[0][1]
+        self.url = f"http://{host}:{port}/v1"
+        return self.url
+
+    async def stop(self) -> None:
+        if self._runner:
+            await self._runner.cleanup()
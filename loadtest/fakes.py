@@ -0,0 +1,123 @@
+"""
+Stand-ins for the discord.py objects the bot touches
+
+Only what src/aclient.py, src/bot.py and utils/message_utils.py actually use is
+implemented. Every send is recorded so the harness can tell when a request has
+been answered.
+"""
+import asyncio
+import itertools
+import contextlib
+
+import discord
+
+_ids = itertools.count(1)
+
+
+class FakeUser:
+    def __init__(self, name: str) -> None:
+        self.id = next(_ids)
+        self.name = name
+        self.mention = f"<@{self.id}>"
+
+    def __str__(self) -> str:
+        return self.name
+
+
+class FakeGuild:
+    def __init__(self) -> None:
+        self.id = next(_ids)
+
+
+class FakeMessage:
+    """A message the bot sent, or a replyall message a user sent"""
+
+    def __init__(self, channel: "FakeChannel", content: str = None, author: FakeUser = None) -> None:
+        self.id = next(_ids)
+        self.channel = channel
+        self.guild = channel.guild
+        self.content = content
+        self.author = author
+        self.reactions = []
+        self.edits = 0
+
+    async def edit(self, content: str = None, **kwargs) -> "FakeMessage":
+        self.content = content
+        self.edits += 1
+        return self
+
+    async def add_reaction(self, emoji: str) -> None:
+        self.reactions.append(emoji)
+
+
+class FakeChannel:
+    def __init__(self, guild: FakeGuild, latency: float = 0.0) -> None:
+        self.id = next(_ids)
+        self.guild = guild
+        # simulated round trip of a Discord API call
+        self.latency = latency
+        self.sent: list[FakeMessage] = []
+
+    def __str__(self) -> str:
+        return f"channel-{self.id}"
+
+    async def send(self, content: str = None, **kwargs) -> FakeMessage:
+        await asyncio.sleep(self.latency)
+        message = FakeMessage(self, content)
+        self.sent.append(message)
+        return message
+
+    @contextlib.asynccontextmanager
+    async def typing(self):
+        yield
+
+
+class FakeResponse:
+    def __init__(self, interaction: "FakeInteraction") -> None:
+        self.interaction = interaction
+        self._done = False
+        self.deferred = False
+
+    def is_done(self) -> bool:
+        return self._done
+
+    async def defer(self, ephemeral: bool = False, thinking: bool = False) -> None:
+        await asyncio.sleep(self.interaction.channel.latency)
+        self._done = True
+        self.deferred = True
+
+    async def send_message(self, content: str = None, ephemeral: bool = False, **kwargs) -> None:
+        await asyncio.sleep(self.interaction.channel.latency)
+        self._done = True
+        self.interaction.replies.append(content)
+
+
+class FakeFollowup:
+    def __init__(self, interaction: "FakeInteraction") -> None:
+        self.interaction = interaction
+
+    async def send(self, content: str = None, wait: bool = False, **kwargs) -> FakeMessage:
+        message = await self.interaction.channel.send(content, **kwargs)
+        self.interaction.replies.append(content)
+        return message
+
+
+class FakeInteraction(discord.Interaction):
+    """Passes the isinstance checks the bot makes without a gateway connection behind it"""
+
+    # plain class attributes shadow the slots and properties of discord.Interaction
+    user = guild = guild_id = channel = channel_id = response = followup = None
+
+    def __init__(self, user: FakeUser, channel: FakeChannel) -> None:
+        self.id = next(_ids)
+        self.user = user
+        self.channel = channel
+        self.channel_id = channel.id
+        self.guild = channel.guild
+        self.guild_id = channel.guild.id
+        self.response = FakeResponse(self)
+        self.followup = FakeFollowup(self)
+        self.replies: list[str] = []
+
+    def __repr__(self) -> str:
+        return f"<FakeInteraction id={self.id} user={self.user}>"
@@ -1,7 +1,10 @@
+import os
 import sys
-import pkg_resources
+import json
+import signal
+import subprocess
+import urllib.request
 
-from src import bot
 from src.log import logger
 from dotenv import load_dotenv
 
@@ -26,6 +29,58 @@ from dotenv import load_dotenv
 #             logger.error(f'{name} version {version} is installed but does not match the requirements')
 #             sys.exit()
 
+
+# the shard count Discord recommends for the bot's number of guilds
+def recommended_shards(token: str) -> int:
+    request = urllib.request.Request(
+        "https://discord.com/api/v10/gateway/bot",
+        headers={"Authorization": f"Bot {token}", "User-Agent": "DiscordBot (https://github.com/jeffreyliuu/OurGPT)"},
+    )
+    with urllib.request.urlopen(request, timeout=10) as response:
+        return json.load(response)["shards"]
+
+
+# runs SHARD_PROCESSES copies of the bot, each with its own share of the shards
+def launch(processes: int) -> int:
+    shard_count = int(os.getenv("SHARD_COUNT") or 0) or recommended_shards(os.getenv("DISCORD_BOT_TOKEN"))
+    # every process needs at least one shard
+    shard_count = max(shard_count, processes)
+    logger.info(f"Starting {processes} processes for {shard_count} shards")
+
+    children = []
+    for index in range(processes):
+        env = {
+            **os.environ,
+            "SHARD_IDS": ",".join(str(shard_id) for shard_id in range(index, shard_count, processes)),
+            "SHARD_COUNT": str(shard_count),
+            "SHARD_PROCESSES": "1",
+        }
+        # each process caches preferences on its own and only clears its own cache on a write,
+        # a short TTL bounds how long the others serve stale ones
+        env.setdefault("PREFERENCE_CACHE_TTL", os.getenv("PREFERENCE_CACHE_TTL_SHARDED", "10"))
+        if os.getenv("METRICS_PORT"):
+            # one metrics endpoint per process
+            env["METRICS_PORT"] = str(int(os.getenv("METRICS_PORT")) + index)
+        children.append(subprocess.Popen([sys.executable, os.path.abspath(__file__)], env=env))
+
+    # `docker stop` signals the launcher only, pass it on so every process can flush and close
+    def forward(signum, frame):
+        for child in children:
+            child.send_signal(signum)
+
+    signal.signal(signal.SIGTERM, forward)
+    # Ctrl+C already reaches the whole process group
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    return max(child.wait() for child in children)
+
+
 if __name__ == '__main__':
     # check_version()
-    bot.run_discord_bot()
\ No newline at end of file
+    load_dotenv()
+    processes = os.getenv("SHARD_PROCESSES", "1")
+    processes = (os.cpu_count() or 1) if processes == "auto" else int(processes)
+    if processes > 1:
+        sys.exit(launch(processes))
+
+    from src import bot
+    bot.run_discord_bot()
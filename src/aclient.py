@@ -1,100 +1,316 @@
 import os
-import json
+import time
+import signal
 import discord
 import asyncio
-from typing import Union
+import contextlib
+import functools
+from typing import TYPE_CHECKING, Union
+from collections import defaultdict
+from datetime import datetime
 
-from src import responses
+from src import responses, personas, openai_chat, command_sync
 from src.log import logger
-from utils.message_utils import send_split_message, send_response_with_images
+from src.dispatcher import ChatRequest, MessageDispatcher, message_author
+from src.sessions import Session, SessionManager
+from src.response_cache import ResponseCache, request_key
+from src.context import ContextWindow
+from src.admission import AdmissionController
+from src.singleflight import SingleFlight
+from src.outbound import Outbox
+from src.guilds import GuildSettings
+from src.metrics import metrics
+from src import metrics as metrics_server
+from utils.message_utils import send_split_message, StreamingResponse
 
 from dotenv import load_dotenv
 from discord import app_commands
 
-from revChatGPT.V3 import Chatbot
-from revChatGPT.V1 import AsyncChatbot
+from src.openai_chat import OpenAIChatbot
+
+# the revChatGPT backends are slow to import, they are only loaded once selected
+if TYPE_CHECKING:
+    from revChatGPT.V3 import Chatbot
+    from revChatGPT.V1 import AsyncChatbot
 
 load_dotenv()
 
-class aclient(discord.Client):
+# SHARD_IDS is set by the launcher in main.py when the shards are spread over several processes
+def shard_config() -> dict:
+    shard_ids = os.getenv("SHARD_IDS")
+    shard_count = os.getenv("SHARD_COUNT")
+    return {
+        "shard_ids": [int(shard_id) for shard_id in shard_ids.split(",")] if shard_ids else None,
+        "shard_count": int(shard_count) if shard_count else None,
+    }
+
+
+class aclient(discord.AutoShardedClient):
     def __init__(self) -> None:
         intents = discord.Intents.default()
         intents.message_content = True
-        super().__init__(intents=intents)
+        super().__init__(intents=intents, **shard_config())
         self.tree = app_commands.CommandTree(self)
-        self.current_channel = None
         self.activity = discord.Activity(type=discord.ActivityType.listening, name="/chat | /help")
-        self.isPrivate = False
-        self.is_replying_all = os.getenv("REPLYING_ALL")
-        self.replying_all_discord_channel_id = os.getenv("REPLYING_ALL_DISCORD_CHANNEL_ID")
+        # mode flags and chat model per guild, see src/guilds.py
+        self.guilds_settings = defaultdict(GuildSettings)
         self.openAI_email = os.getenv("OPENAI_EMAIL")
         self.openAI_password = os.getenv("OPENAI_PASSWORD")
         self.openAI_API_key = os.getenv("OPENAI_API_KEY")
-        self.openAI_gpt_engine = os.getenv("GPT_ENGINE")
         self.chatgpt_session_token = os.getenv("SESSION_TOKEN")
         self.chatgpt_access_token = os.getenv("ACCESS_TOKEN")
         self.chatgpt_paid = os.getenv("PUID")
 
+        # "native" answers OFFICIAL requests with the asyncio client in src/openai_chat.py
+        self.official_backend = os.getenv("OFFICIAL_BACKEND", "revChatGPT")
+        self.stream_responses = os.getenv("STREAM_RESPONSES", "True") == "True"
+        self.response_cache = ResponseCache() if os.getenv("RESPONSE_CACHE") == "True" else None
+        self.context = ContextWindow()
+        # identical requests arriving while one is being answered share that answer
+        self.in_flight = SingleFlight() if os.getenv("CHAT_COALESCE", "True") == "True" else None
+        self.sessions = SessionManager(lambda key: self.get_chatbot_model(guild_id=key[0]))
+        self.admission = AdmissionController()
+        self.dispatcher = MessageDispatcher(self.send_message, on_error=self.send_error, on_done=self.admission.release)
+        # every reply to Discord goes out through here
+        self.outbox = Outbox()
+        # set up by setup_bot once the database is connected
+        self.repository = None
+        self.interaction_log = None
+        self.history = None
+        self.metrics_server = None
+        self.created_at = time.monotonic()
+        # set the first time on_ready fires, it fires again after every reconnect
+        self.ready_at = None
+        self.startup_timings = {}
+
+        metrics.gauge("queue_depth", self.dispatcher.depth)
+        metrics.gauge("workers_busy", lambda: self.dispatcher.busy)
+        metrics.gauge("chat_in_flight", lambda: sum(self.admission.in_flight.values()))
+        metrics.gauge("sessions", lambda: len(self.sessions))
+        metrics.gauge("outbound_queued", self.outbox.depth)
+
+    # only read once something needs it
+    @functools.cached_property
+    def starting_prompt(self) -> str:
         config_dir = os.path.abspath(f"{__file__}/../../")
         prompt_name = 'starting-prompt.txt'
         prompt_path = os.path.join(config_dir, prompt_name)
         with open(prompt_path, "r", encoding="utf-8") as f:
-            self.starting_prompt = f.read()
+            return f.read()
+
+    async def setup_hook(self) -> None:
+        if self.interaction_log:
+            self.interaction_log.start()
+        if self.history:
+            self.history.start()
+        self.metrics_server = await metrics_server.serve()
+        # `docker stop` sends SIGTERM, close cleanly so buffered interactions are flushed
+        with contextlib.suppress(NotImplementedError):
+            asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, lambda: asyncio.create_task(self.close()))
+
+    async def close(self) -> None:
+        if self.metrics_server:
+            self.metrics_server.close()
+        if self.interaction_log:
+            await self.interaction_log.close()
+        if self.history:
+            await self.history.close()
+        if self.repository:
+            self.repository.close()
+        await openai_chat.close()
+        await super().close()
 
-        self.chat_model = os.getenv("CHAT_MODEL")
-        self.chatbot = self.get_chatbot_model()
-        self.message_queue = asyncio.Queue()
+    def settings(self, guild_id) -> GuildSettings:
+        return self.guilds_settings[guild_id]
 
-    def get_chatbot_model(self, prompt = None) -> Union[AsyncChatbot, Chatbot]:
+    def get_chatbot_model(self, prompt = None, guild_id = None) -> Union["AsyncChatbot", "Chatbot", OpenAIChatbot]:
         if not prompt:
             prompt = self.starting_prompt
-        if self.chat_model == "UNOFFICIAL":
+        settings = self.settings(guild_id)
+        if settings.chat_model == "UNOFFICIAL":
+            from revChatGPT.V1 import AsyncChatbot
             return AsyncChatbot(config = {
                 "access_token": self.chatgpt_access_token,
-                "model": "text-davinci-002-render-sha" if self.openAI_gpt_engine == "gpt-3.5-turbo" else self.openAI_gpt_engine,
+                "model": "text-davinci-002-render-sha" if settings.openAI_gpt_engine == "gpt-3.5-turbo" else settings.openAI_gpt_engine,
                 "PUID": self.chatgpt_paid
             })
-        elif self.chat_model == "OFFICIAL":
-                return Chatbot(api_key=self.openAI_API_key, engine=self.openAI_gpt_engine, system_prompt=prompt)
-
-    async def process_messages(self):
-        while True:
-            if self.current_channel is not None:
-                while not self.message_queue.empty():
-                    async with self.current_channel.typing():
-                        message, user_message = await self.message_queue.get()
-                        try:
-                            await self.send_message(message, user_message)
-                        except Exception as e:
-                            logger.exception(f"Error while processing message: {e}")
-                        finally:
-                            self.message_queue.task_done()
-            await asyncio.sleep(1)
-
-
-    async def enqueue_message(self, message, user_message):
-        await message.response.defer(ephemeral=self.isPrivate) if self.is_replying_all == "False" else None
-        await self.message_queue.put((message, user_message))
-
-    async def send_message(self, message, user_message):
-        if self.is_replying_all == "False":
-            author = message.user.id
-        else:
-            author = message.author.id
+        elif settings.chat_model == "OFFICIAL":
+            if self.official_backend == "native":
+                return OpenAIChatbot(api_key=self.openAI_API_key, engine=settings.openAI_gpt_engine, system_prompt=prompt)
+            from revChatGPT.V3 import Chatbot
+            return Chatbot(api_key=self.openAI_API_key, engine=settings.openAI_gpt_engine, system_prompt=prompt)
+
+    # replays the stored history of a conversation the first time it is used in this process
+    async def restore_session(self, session: Session) -> None:
+        session.restored = True
+        # UNOFFICIAL holds its history on the website
+        if not self.history or self.settings(session.key[0]).chat_model != "OFFICIAL":
+            return
         try:
-            response = (f'> **{user_message}** - <@{str(author)}> \n\n')
-            if self.chat_model == "OFFICIAL":
-                response = f"{response}{await responses.official_handle_response(user_message, self)}"
-                await send_split_message(self, response, message)
-            elif self.chat_model == "UNOFFICIAL":
-                response = f"{response}{await responses.unofficial_handle_response(user_message, self)}"
-                await send_split_message(self, response, message)
+            persona, turns = await self.history.load(session.key)
         except Exception as e:
-            logger.exception(f"Error while sending : {e}")
-            if self.is_replying_all == "True":
-                await message.channel.send(f"> **ERROR: Something went wrong, please try again later!** \n ```ERROR MESSAGE: {e}```")
+            logger.exception(f"Error while restoring conversation {session.key}, starting a new one: {e}")
+            return
+        if persona in personas.PERSONAS:
+            session.chatbot = self.get_chatbot_model(prompt=personas.PERSONAS[persona], guild_id=session.key[0])
+            session.persona = persona
+        for prompt, answer in turns:
+            session.record_turn(prompt, answer)
+
+    # /reset and persona switches, the conversation is only restored from here on
+    def forget(self, key: tuple, persona: str = "standard") -> None:
+        if self.history:
+            self.history.reset(key, persona)
+
+    async def ask(self, session: Session, prompt: str, on_update=None, use_cache: bool = True) -> Union[str, None]:
+        async with session.lock:
+            if not session.restored:
+                await self.restore_session(session)
+            answer = await self._answer(session, prompt, on_update, use_cache)
+            if answer and self.history:
+                self.history.record(session.key, session.persona, prompt, answer)
+            # the answer grew the history, keeps the memory cap's running total current
+            self.sessions.resize(session)
+            return answer
+
+    async def _answer(self, session: Session, prompt: str, on_update=None, use_cache: bool = True) -> Union[str, None]:
+        # computed before asking, the answer changes the conversation the key is based on
+        key = request_key(self, session, prompt) if self.response_cache or self.in_flight else None
+        if self.response_cache and use_cache:
+            answer = self.response_cache.get(key)
+            if answer is not None:
+                metrics.inc("chat_answers_total", source="cache")
+                session.record_turn(prompt, answer)
+                return answer
+
+        started = time.monotonic()
+        if self.in_flight:
+            answer, shared = await self.in_flight.do(key, lambda: self._ask_backend(session, prompt, on_update))
+            if shared:
+                metrics.inc("chat_answers_total", source="coalesced")
+                if answer:
+                    session.record_turn(prompt, answer)
+                return answer
+        else:
+            answer = await self._ask_backend(session, prompt, on_update)
+        metrics.inc("chat_answers_total", source="backend")
+        if self.response_cache and answer:
+            self.response_cache.set(key, answer, time.monotonic() - started)
+        return answer
+
+    async def _ask_backend(self, session: Session, prompt: str, on_update=None) -> Union[str, None]:
+        chat_model = self.settings(session.key[0]).chat_model
+        if chat_model == "OFFICIAL":
+            with metrics.time("context"):
+                await self.context.fit(session.chatbot, prompt)
+            with metrics.time("backend", model="official"):
+                return await responses.official_handle_response(prompt, session.chatbot, on_update)
+        elif chat_model == "UNOFFICIAL":
+            if not session.primed and self.starting_prompt:
+                prompt = f"{self.starting_prompt}\n\n{prompt}"
+            with metrics.time("backend", model="unofficial"):
+                response = await responses.unofficial_handle_response(prompt, session.chatbot, on_update)
+            session.primed = True
+            return response
+
+    async def enqueue_message(self, message, user_message, original=None, use_cache=True):
+        priority = "interactive" if isinstance(message, discord.Interaction) else "replyall"
+        request = ChatRequest(message, user_message, original, use_cache, priority)
+        retry_after = self.admission.admit(request, self.dispatcher.depth(), self.dispatcher.estimated_wait())
+        if retry_after is not None:
+            logger.warning(f"Rejected message from {message_author(message)}, retry in {retry_after}s")
+            metrics.inc("chat_rejected_total")
+            if isinstance(message, discord.Interaction):
+                await message.response.send_message(
+                    f"> **WARN: The server is busy, please try again in {retry_after} s**", ephemeral=True)
             else:
-                await message.followup.send(f"> **ERROR: Something went wrong, please try again later!** \n ```ERROR MESSAGE: {e}```")
+                # a reaction instead of a reply so a spammed replyall channel does not get spammed back
+                await message.add_reaction("⏳")
+            return
+        try:
+            await message.response.defer(ephemeral=self.settings(request.key[0]).isPrivate) if priority == "interactive" else None
+            await self.dispatcher.put(request)
+        except Exception:
+            self.admission.release(request)
+            raise
+
+    def log_interaction(self, request: ChatRequest, answer: str = None, error: Exception = None) -> None:
+        if not self.interaction_log:
+            return
+        now = time.monotonic()
+        settings = self.settings(request.key[0])
+        self.interaction_log.add({
+            "username": str(message_author(request.message)),
+            "interaction": request.original,
+            "guild": request.key[0],
+            "channel": request.key[1],
+            "model": settings.chat_model,
+            "engine": settings.openAI_gpt_engine,
+            "response_length": len(answer) if answer else 0,
+            "queue_ms": round((request.started_at - request.enqueued_at) * 1000) if request.started_at else None,
+            "latency_ms": round((now - request.enqueued_at) * 1000),
+            "error": type(error).__name__ if error else None,
+            "timestamp": datetime.utcnow(),
+        })
+
+    async def send_message(self, request: ChatRequest):
+        message, user_message = request.message, request.user_message
+        author = message_author(message).id
+        metrics.observe("queue_wait", request.started_at - request.enqueued_at)
+        response = (f'> **{user_message}** - <@{str(author)}> \n\n')
+        session = self.sessions.get(request.key)
+        if self.stream_responses:
+            stream, answer = StreamingResponse(self, message, header=response), None
+            try:
+                answer = await self.ask(session, user_message, on_update=stream.update, use_cache=request.use_cache)
+            finally:
+                # also stops the edit loop when the backend fails halfway through
+                with metrics.time("send"):
+                    await stream.finish(answer)
+        else:
+            answer = await self.ask(session, user_message, use_cache=request.use_cache)
+            if answer is not None:
+                response = f"{response}{answer}"
+                with metrics.time("send"):
+                    await send_split_message(self, response, message)
+        self.log_interaction(request, answer)
+
+    # called by the dispatcher when a request failed, whatever stage it failed at
+    async def send_error(self, request: ChatRequest, error: Exception) -> None:
+        message = request.message
+        metrics.error("chat", error)
+        self.log_interaction(request, error=error)
+        send = message.followup.send if isinstance(message, discord.Interaction) else message.channel.send
+        await self.outbox.send(message.channel.id, send, f"> **ERROR: Something went wrong, please try again later!** \n ```ERROR MESSAGE: {error}```")
+
+    async def _startup_phase(self, phase: str, coro) -> None:
+        started = time.monotonic()
+        try:
+            await coro
+        except Exception as e:
+            logger.exception(f"Error during startup phase {phase}: {e}")
+        finally:
+            self.startup_timings[phase] = time.monotonic() - started
+            metrics.observe("startup", self.startup_timings[phase], phase=phase)
+
+    async def _prepare_database(self) -> None:
+        await self.repository.warm_up()
+        await self.repository.migrate()
+
+    # everything on_ready has to do, side by side, once the workers are already taking messages
+    async def start_up(self) -> None:
+        self.startup_timings["connect"] = self.ready_at - self.created_at
+        metrics.observe("startup", self.startup_timings["connect"], phase="connect")
+        phases = {
+            # the commands are global, with the shards spread over processes only the one with shard 0 syncs
+            "sync": command_sync.sync_commands(self.tree) if not self.shard_ids or 0 in self.shard_ids else asyncio.sleep(0),
+            "database": self._prepare_database() if self.repository else asyncio.sleep(0),
+            "http": openai_chat.warm_up() if self.official_backend == "native" else asyncio.sleep(0),
+            "tokenizer": self.context.warm_up(),
+            "start_prompt": self.send_start_prompt(),
+        }
+        await asyncio.gather(*(self._startup_phase(phase, coro) for phase, coro in phases.items()))
+        logger.info("Startup took " + ", ".join(f"{phase} {seconds:.2f}s" for phase, seconds in self.startup_timings.items()))
 
     async def send_start_prompt(self):
         discord_channel_id = os.getenv("DISCORD_CHANNEL_ID")
@@ -102,13 +318,17 @@ class aclient(discord.Client):
             if self.starting_prompt:
                 if (discord_channel_id):
                     channel = self.get_channel(int(discord_channel_id))
+                    if channel is None:
+                        # the channel's guild is served by a shard in another process
+                        return
                     logger.info(f"Send system prompt with size {len(self.starting_prompt)}")
-                    response = ""
-                    if self.chat_model == "OFFICIAL":
-                        response = f"{response}{await responses.official_handle_response(self.starting_prompt, self)}"
-                        await channel.send(response)
-                    elif self.chat_model == "UNOFFICIAL":
-                        response = f"{response}{await responses.unofficial_handle_response(self.starting_prompt, self)}"
+                    # the channel itself gets a conversation, user conversations carry the prompt on their own
+                    session = self.sessions.get((channel.guild.id, channel.id, None))
+                    # a new conversation on every start
+                    self.forget(session.key)
+                    session.primed = True
+                    response = await self.ask(session, self.starting_prompt)
+                    if response is not None:
                         await channel.send(response)
                     logger.info(f"System prompt response:{response}")
                 else:
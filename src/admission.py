@@ -0,0 +1,101 @@
+"""
+Module responsible for deciding whether a chat message may join the queue
+
+A message is turned away when the queue is already full, when its author has
+too many messages in flight, or when the author or channel has run out of
+rate-limit tokens. Each rejection comes with a hint of when to try again.
+"""
+import os
+import math
+import time
+from typing import Union
+from collections import Counter, OrderedDict
+
+from src.dispatcher import ChatRequest
+
+
+class TokenBucket:
+    """Refills rate tokens a second up to burst, every admitted message takes one"""
+
+    def __init__(self, rate: float, burst: float) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # seconds until a token is available, 0 when one is available now
+    def wait_time(self) -> float:
+        self._refill()
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self) -> None:
+        self.tokens -= 1
+
+
+class AdmissionController:
+    """Per-user and per-channel limits in front of the message queue, a rate of 0 disables that limit"""
+
+    def __init__(self) -> None:
+        self.user_rate = float(os.getenv("CHAT_USER_RATE", 0.1))
+        self.user_burst = float(os.getenv("CHAT_USER_BURST", 5))
+        self.channel_rate = float(os.getenv("CHAT_CHANNEL_RATE", 1))
+        self.channel_burst = float(os.getenv("CHAT_CHANNEL_BURST", 20))
+        self.max_queue = int(os.getenv("CHAT_MAX_QUEUE", 200))
+        self.max_in_flight = int(os.getenv("CHAT_MAX_IN_FLIGHT", 2))
+        # only the most recently seen users and channels keep a bucket, a forgotten one starts full again
+        self.max_tracked = int(os.getenv("CHAT_RATE_TRACKED", 10000))
+        self._buckets: OrderedDict[tuple, TokenBucket] = OrderedDict()
+        self.in_flight = Counter()
+        self.rejected = Counter()
+
+    def _bucket(self, key: tuple, rate: float, burst: float) -> TokenBucket:
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(rate, burst)
+            if len(self._buckets) > self.max_tracked:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+        return bucket
+
+    # None when the request is admitted, otherwise the number of seconds to wait before trying again
+    def admit(self, request: ChatRequest, queue_depth: int, queue_wait: float) -> Union[int, None]:
+        guild_id, channel_id, user_id = request.key
+        if queue_depth >= self.max_queue:
+            return self._reject("queue_full", queue_wait)
+        if self.in_flight[user_id] >= self.max_in_flight:
+            return self._reject("in_flight", queue_wait)
+
+        buckets = []
+        if self.user_rate:
+            buckets.append(("user", self._bucket(("user", user_id), self.user_rate, self.user_burst)))
+        if self.channel_rate:
+            buckets.append(("channel", self._bucket(("channel", channel_id), self.channel_rate, self.channel_burst)))
+        # nothing is taken unless every bucket has a token
+        for name, bucket in buckets:
+            wait = bucket.wait_time()
+            if wait:
+                return self._reject(f"{name}_rate", wait)
+        for _, bucket in buckets:
+            bucket.take()
+
+        self.in_flight[user_id] += 1
+        return None
+
+    def _reject(self, reason: str, retry_after: float) -> int:
+        self.rejected[reason] += 1
+        return max(1, math.ceil(retry_after))
+
+    def release(self, request: ChatRequest) -> None:
+        user_id = request.key[2]
+        self.in_flight[user_id] -= 1
+        if self.in_flight[user_id] <= 0:
+            del self.in_flight[user_id]
+
+    def stats(self) -> dict:
+        return {"rejected": sum(self.rejected.values()), **{f"rejected_{reason}": count for reason, count in self.rejected.items()}}
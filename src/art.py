@@ -2,10 +2,14 @@
 Module responsible for the AI Art generation using Dalle2
 
 Returns:
-    The path to the generated 512 x 512 image
+    The generated 1024 x 1024 images as PNG bytes, kept in memory
 """
 import os
-import json
+import asyncio
+import hashlib
+import threading
+import contextlib
+from collections import Counter, OrderedDict
 
 import openai
 from pathlib import Path
@@ -13,53 +17,144 @@ from base64 import b64decode
 from dotenv import load_dotenv
 from asgiref.sync import sync_to_async
 
+from src.log import logger
+from src.metrics import metrics
+
 load_dotenv()
 openai.api_key = os.getenv("OPENAI_API_KEY")
 
 
-# generate 512x512 image and save to a file
-# return the path of the image as a str
-async def draw(prompt, amount) -> list[str]:
-    DATA_DIR = Path.cwd()
-    DATA_DIR.mkdir(exist_ok=True)
-
-    response = await sync_to_async(openai.Image.create)(
-        prompt=prompt,
-        n=amount,
-        size="1024x1024",
-        response_format="b64_json",
-    )
-    with open("response.log", mode="w", encoding="utf-8") as file:
-        json.dump(response, file)
-
-    file_name = DATA_DIR / f"{prompt[:5]}-{response['created']}.json"
-
-    with open(file_name, mode="w", encoding="utf-8") as file:
-        json.dump(response, file)
-
-    path = await convert(file_name)
-    path = [str(p) for p in path]
-    return path
-
-# code stolen from https://realpython.com/generate-images-with-dalle-openai-api/
-async def convert(path):
-    DATA_DIR = Path.cwd() / "responses"
-    JSON_FILE = DATA_DIR / path
-    IMAGE_DIR = Path.cwd() / "images"
-    IMAGE_DIR.mkdir(parents=True, exist_ok=True)
-
-    with open(JSON_FILE, mode="r", encoding="utf-8") as file:
-        response = json.load(file)
-    image_files = []
-    for index, image_dict in enumerate(response["data"]):
-        image_data = b64decode(image_dict["b64_json"])
-        image_file = IMAGE_DIR / f"{JSON_FILE.stem}-{index}.png"
-        image_files.append(image_file)
-
-        with open(image_file, mode="wb") as png:
-            png.write(image_data)
-
-        # delete uneeded json file
-    os.remove(path)
-
-    return image_files
\ No newline at end of file
+class DrawLimitExceeded(Exception):
+    pass
+
+
+class DrawLimiter:
+    """Global cap on concurrent image API calls and per-user cap on concurrent /draw commands"""
+
+    def __init__(self, concurrency: int, per_user: int) -> None:
+        self.concurrency = concurrency
+        self.per_user = per_user
+        self._slots = asyncio.Semaphore(concurrency)
+        self._users = Counter()
+        self.active = 0
+        self.waiting = 0
+
+    # 0 when an API call could start right now, otherwise how many calls are ahead plus one
+    def queue_position(self) -> int:
+        ahead = self.active + self.waiting - self.concurrency
+        return ahead + 1 if ahead >= 0 else 0
+
+    @contextlib.contextmanager
+    def user(self, user_id: int):
+        if self._users[user_id] >= self.per_user:
+            raise DrawLimitExceeded()
+        self._users[user_id] += 1
+        try:
+            yield
+        finally:
+            self._users[user_id] -= 1
+            if not self._users[user_id]:
+                del self._users[user_id]
+
+    @contextlib.asynccontextmanager
+    async def slot(self):
+        self.waiting += 1
+        try:
+            await self._slots.acquire()
+        finally:
+            self.waiting -= 1
+        self.active += 1
+        try:
+            yield
+        finally:
+            self.active -= 1
+            self._slots.release()
+
+
+limiter = DrawLimiter(int(os.getenv("DRAW_CONCURRENCY", 4)), int(os.getenv("DRAW_PER_USER", 1)))
+# images asked for in one API call, bigger requests are split into parallel calls
+DRAW_BATCH_SIZE = int(os.getenv("DRAW_BATCH_SIZE", 2))
+metrics.gauge("draw_active", lambda: limiter.active)
+metrics.gauge("draw_waiting", lambda: limiter.waiting)
+
+
+class ImageStore:
+    """Content-addressed PNG store, the oldest files are removed once it grows past max_bytes"""
+
+    def __init__(self, directory: str, max_bytes: int) -> None:
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        # the directory is only listed here, after that the files and their sizes are tracked in memory, oldest first
+        self._lock = threading.Lock()
+        self._files: OrderedDict[Path, int] = OrderedDict()
+        stats = [(path, path.stat()) for path in self.directory.glob("*.png")]
+        for path, stat in sorted(stats, key=lambda item: item[1].st_mtime):
+            self._files[path] = stat.st_size
+        self.total = sum(self._files.values())
+        self._trim()
+
+    # called from several threads at once
+    def put(self, data: bytes) -> Path:
+        path = self.directory / f"{hashlib.sha256(data).hexdigest()}.png"
+        with self._lock:
+            if path in self._files:
+                # same image again, refresh it so it is the last to be trimmed
+                self._files.move_to_end(path)
+                path.touch()
+            else:
+                path.write_bytes(data)
+                self._files[path] = len(data)
+                self.total += len(data)
+                self._trim()
+        return path
+
+    def _trim(self) -> None:
+        while self.total > self.max_bytes and self._files:
+            path, size = self._files.popitem(last=False)
+            self.total -= size
+            path.unlink(missing_ok=True)
+
+
+# images are only written to disk when IMAGE_STORE_DIR is set
+image_store = None
+if os.getenv("IMAGE_STORE_DIR"):
+    image_store = ImageStore(os.getenv("IMAGE_STORE_DIR"), int(os.getenv("IMAGE_STORE_MAX_BYTES", 256 * 1024 * 1024)))
+
+
+async def _generate(prompt, amount) -> list[bytes]:
+    async with limiter.slot():
+        with metrics.time("draw", images=amount):
+            response = await openai.Image.acreate(
+                prompt=prompt,
+                n=amount,
+                size="1024x1024",
+                response_format="b64_json",
+            )
+    images = convert(response)
+
+    if image_store:
+        try:
+            for image in images:
+                await sync_to_async(image_store.put, thread_sensitive=False)(image)
+        except Exception as e:
+            logger.exception(f"Error while storing images: {e}")
+
+    return images
+
+# generate 1024x1024 images in parallel sub-requests, yielding each batch of PNG bytes as soon as it is done
+async def draw_batches(prompt, amount):
+    tasks = [
+        asyncio.create_task(_generate(prompt, min(DRAW_BATCH_SIZE, amount - start)))
+        for start in range(0, amount, DRAW_BATCH_SIZE)
+    ]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            yield await next_done
+    finally:
+        for task in tasks:
+            task.cancel()
+
+# decode the base64 payload straight into memory, no intermediate JSON or PNG files
+def convert(response) -> list[bytes]:
+    return [b64decode(image_dict["b64_json"]) for image_dict in response["data"]]
@@ -1,60 +1,53 @@
 # pylint: disable=line-too-long
 """Main module responsible for handling messages"""
 
+import io
 import os
+import contextlib
+import time
 import openai
-import asyncio
 import discord
 from src.log import logger
 from random import randrange
 from src.aclient import client
+from src.dispatcher import conversation_key
+from src.metrics import metrics
+from src.user_pages import UserPages
 from discord import app_commands
-from pymongo import MongoClient
 from datetime import datetime
+from pymongo.errors import DuplicateKeyError
 
 
-from src import log, art, personas, responses
+from src import art, personas, responses, database
+from src.history import ConversationHistory
 
 
-def run_discord_bot():
-
-    # Connect to MongoDB
-    try:
-        # Connect to MongoDB
-        mongo_client = MongoClient('mongodb://host.docker.internal:27017')
-        
-        # Access the database
-        db = mongo_client['ourgpt_development']
+# registers the events and slash commands on the client, kept apart from run_discord_bot
+# so the load test harness can drive the same handlers without a gateway connection
+def setup_bot():
 
-        # Access the collections
-        preferences_collection = db['preferences']
-        interactions_collection = db['interactions']
-        
-        user_preferences = preferences_collection.find_one({"username": "blueberry"})
-        print(user_preferences)
-        
-    except Exception as e:
-        print(f"An error occurred: {e}")
+    # Connect to MongoDB, every call goes through the async repository
+    repository = client.repository = database.connect()
+    client.interaction_log = database.InteractionWriter(repository)
+    # conversations are kept across restarts, see src/history.py
+    if os.getenv("CONVERSATION_HISTORY", "True") == "True":
+        client.history = ConversationHistory(repository)
 
     @client.event
     async def on_ready():
-        await client.send_start_prompt()
-        await client.tree.sync()
-        loop = asyncio.get_event_loop()
-        loop.create_task(client.process_messages())
+        if client.ready_at:
+            logger.info(f'{client.user} reconnected')
+            return
+        client.ready_at = time.monotonic()
+        # take messages straight away, the command sync and the start prompt do not have to come first
+        client.dispatcher.start()
         logger.info(f'{client.user} is now running!')
+        await client.start_up()
     
     @client.tree.command(name="register", description="Register a new user with preferences")
     async def register(interaction: discord.Interaction, *, name: str, major: str, preference1: str, preference2: str):
         username = str(interaction.user)
         try:
-            # Check if the user is already registered
-            existing_user = preferences_collection.find_one({"username": username})
-
-            if existing_user:
-                await interaction.response.send_message("You are already registered.")
-                return
-
             # Get the current date and time
             register_date = datetime.utcnow()
 
@@ -67,8 +60,13 @@ def run_discord_bot():
             }
 
             # Insert the data and check for errors
-            insert_result = preferences_collection.insert_one(data_to_insert)
-            if not insert_result.acknowledged:
+            # the unique index on username rejects a second registration
+            try:
+                acknowledged = await repository.register_user(data_to_insert)
+            except DuplicateKeyError:
+                await interaction.response.send_message("You are already registered.")
+                return
+            if not acknowledged:
                 await interaction.response.send_message("Failed to register.")
                 return
 
@@ -87,50 +85,51 @@ def run_discord_bot():
 
         username = str(interaction.user)
 
+        if not confirm_deletion.value:
+            # Data has not been deleted
+            await interaction.followup.send("Your data deletion has been cancelled.")
+            return
+
         # Check if the user is in the database
-        existing_user = preferences_collection.find_one({"username": username})
+        existing_user = await repository.find_user(username)
+
+        # stored conversations are deleted too, registered or not
+        client.sessions.drop_user(interaction.user.id)
+        deleted_turns = await client.history.delete_user(interaction.user.id) if client.history else 0
 
-        if not existing_user:
+        if not existing_user and not deleted_turns:
             await interaction.followup.send("You are not registered in the database.")
             return
 
-        if confirm_deletion:
-            # Delete the user from the database
-            preferences_collection.delete_one({"username": username})
+        # Delete the user from the database
+        if existing_user:
+            await repository.delete_user(username)
 
-            # Confirm deletion to the user
-            await interaction.followup.send("Your data has been deleted.")
-        else:
-            # Data has not been deleted
-            await interaction.followup.send("Your data deletion has been cancelled.")
+        # Confirm deletion to the user
+        await interaction.followup.send("Your data has been deleted.")
 
     @client.tree.command(name="list_users", description="See who is registered in the server")
-    async def list_users(interaction: discord.Interaction):
+    @app_commands.describe(page="Page to start from", sort="Order of the users", starts_with="Only usernames starting with this")
+    @app_commands.choices(sort=[
+        app_commands.Choice(name="Username A-Z", value="username"),
+        app_commands.Choice(name="Username Z-A", value="username_desc"),
+        app_commands.Choice(name="Newest first", value="newest"),
+        app_commands.Choice(name="Oldest first", value="oldest"),
+    ])
+    async def list_users(interaction: discord.Interaction, page: app_commands.Range[int, 1] = 1,
+                         sort: app_commands.Choice[str] = None, starts_with: str = None):
+        order = {
+            "username": ("username", False),
+            "username_desc": ("username", True),
+            "newest": ("registered", True),
+            "oldest": ("registered", False),
+        }[sort.value if sort else "username"]
         try:
-            # Fetch all documents from the database collection
-            all_users = preferences_collection.find({})
-
-            # Initialize message
-            message = "**Registered Users**\n```"
-
-            # Add table headers
-            message += f"{'Username':<20} | {'Register Date':<25}\n"
-            message += "-" * 48 + "\n"
-
-            # Add each user to the table
-            for user in all_users:
-                username = user.get("username", "N/A")
-                register_date = user.get("register_date", "N/A")
-                if isinstance(register_date, datetime):
-                    register_date = register_date.strftime('%Y-%m-%d %H:%M:%S')
-
-                message += f"{username:<20} | {register_date:<25}\n"
-
-            # Close code block
-            message += "```"
-
-            # Send the message
-            await interaction.response.send_message(message)
+            # one page at a time, the buttons fetch the next ones
+            view = UserPages(repository, interaction.user.id, *order, prefix=starts_with)
+            await view.load(page)
+            view.interaction = interaction
+            await interaction.response.send_message(view.content(), view=view)
         except Exception as e:
             await interaction.response.send_message(f"An error occurred: {str(e)}")
 
@@ -144,19 +143,16 @@ def run_discord_bot():
             username = str(interaction.user)
 
             # Check if the user is already registered
-            existing_user = preferences_collection.find_one({"username": username})
+            existing_user = await repository.find_user(username)
 
             if not existing_user:
                 await interaction.response.send_message("You are not registered. Please register first.")
                 return
 
             # Add the new preferences to the existing preferences
-            update_result = preferences_collection.update_one(
-                {"username": username},
-                {"$addToSet": {"preferences": {"$each": preferences_list}}}
-            )
+            modified_count = await repository.add_preferences(username, preferences_list)
 
-            if update_result.modified_count == 0:
+            if modified_count == 0:
                 await interaction.response.send_message("Preferences already exist or failed to update.")
                 return
 
@@ -167,8 +163,9 @@ def run_discord_bot():
             await interaction.response.send_message(f"An error occurred: {str(e)}")
         
     @client.tree.command(name="chat", description="Have a chat with ChatGPT")
-    async def chat(interaction: discord.Interaction, *, message: str):
-        if client.is_replying_all == "True":
+    @app_commands.describe(fresh="Ask the model even if this question was answered before")
+    async def chat(interaction: discord.Interaction, *, message: str, fresh: bool = False):
+        if client.settings(interaction.guild_id).is_replying_all == "True":
             await interaction.response.defer(ephemeral=False)
             await interaction.followup.send(
                 "> **WARN: You already on replyAll mode. If you want to use the Slash Command, switch to normal mode by using `/replyall` again**")
@@ -177,34 +174,24 @@ def run_discord_bot():
         if interaction.user == client.user:
             return
         username = str(interaction.user)
-        client.current_channel = interaction.channel
         logger.info(
-            f"\x1b[31m{username}\x1b[0m : /chat [{message}] in ({client.current_channel})")
+            f"\x1b[31m{username}\x1b[0m : /chat [{message}] in ({interaction.channel})")
 
         # Parse preferences
-        user_preferences = preferences_collection.find_one({"username": username})
-        if user_preferences:
-            preferences = user_preferences.get('preferences', [])
-            name = username
-            preferences_str = ", ".join(preferences)  # Convert list to string
-
-            if preferences:
-                condensed_preferences = f"These are my preferences: {preferences_str} I ask: {message}"
-            else:
-                condensed_preferences = message
-        else:
-            condensed_preferences = message
-        
-        # Store interaction
-        interactions_collection.insert_one({"username": username, "interaction": message})
-        await client.enqueue_message(interaction, condensed_preferences)
+        with metrics.time("preferences"):
+            user_preferences = await repository.find_user(username)
+        condensed_preferences = responses.preference_prompt(user_preferences, message)
+
+        # the interaction is logged once it has been answered
+        await client.enqueue_message(interaction, condensed_preferences, message, use_cache=not fresh)
 
 
     @client.tree.command(name="private", description="Toggle private access")
     async def private(interaction: discord.Interaction):
         await interaction.response.defer(ephemeral=False)
-        if not client.isPrivate:
-            client.isPrivate = not client.isPrivate
+        settings = client.settings(interaction.guild_id)
+        if not settings.isPrivate:
+            settings.isPrivate = not settings.isPrivate
             logger.warning("\x1b[31mSwitch to private mode\x1b[0m")
             await interaction.followup.send(
                 "> **INFO: Next, the response will be sent via private reply. If you want to switch back to public mode, use `/public`**")
@@ -217,8 +204,9 @@ def run_discord_bot():
     @client.tree.command(name="public", description="Toggle public access")
     async def public(interaction: discord.Interaction):
         await interaction.response.defer(ephemeral=False)
-        if client.isPrivate:
-            client.isPrivate = not client.isPrivate
+        settings = client.settings(interaction.guild_id)
+        if settings.isPrivate:
+            settings.isPrivate = not settings.isPrivate
             await interaction.followup.send(
                 "> **INFO: Next, the response will be sent to the channel directly. If you want to switch back to private mode, use `/private`**")
             logger.warning("\x1b[31mSwitch to public mode\x1b[0m")
@@ -230,15 +218,16 @@ def run_discord_bot():
 
     @client.tree.command(name="replyall", description="Toggle replyAll access")
     async def replyall(interaction: discord.Interaction):
-        client.replying_all_discord_channel_id = str(interaction.channel_id)
+        settings = client.settings(interaction.guild_id)
+        settings.replying_all_discord_channel_id = str(interaction.channel_id)
         await interaction.response.defer(ephemeral=False)
-        if client.is_replying_all == "True":
-            client.is_replying_all = "False"
+        if settings.is_replying_all == "True":
+            settings.is_replying_all = "False"
             await interaction.followup.send(
                 "> **INFO: Next, the bot will response to the Slash Command. If you want to switch back to replyAll mode, use `/replyAll` again**")
             logger.warning("\x1b[31mSwitch to normal mode\x1b[0m")
-        elif client.is_replying_all == "False":
-            client.is_replying_all = "True"
+        elif settings.is_replying_all == "False":
+            settings.is_replying_all = "True"
             await interaction.followup.send(
                 "> **INFO: Next, the bot will disable Slash Command and responding to all message in this channel only. If you want to switch back to normal mode, use `/replyAll` again**")
             logger.warning("\x1b[31mSwitch to replyAll mode\x1b[0m")
@@ -254,33 +243,35 @@ def run_discord_bot():
 
     async def chat_model(interaction: discord.Interaction, choices: app_commands.Choice[str]):
         await interaction.response.defer(ephemeral=False)
-        original_chat_model = client.chat_model
-        original_openAI_gpt_engine = client.openAI_gpt_engine
+        settings = client.settings(interaction.guild_id)
+        original_chat_model = settings.chat_model
+        original_openAI_gpt_engine = settings.openAI_gpt_engine
 
         try:
             if choices.value == "OFFICIAL":
-                client.openAI_gpt_engine = "gpt-3.5-turbo"
-                client.chat_model = "OFFICIAL"
+                settings.openAI_gpt_engine = "gpt-3.5-turbo"
+                settings.chat_model = "OFFICIAL"
             elif choices.value == "OFFICIAL-GPT4":
-                client.openAI_gpt_engine = "gpt-4"
-                client.chat_model = "OFFICIAL"
+                settings.openAI_gpt_engine = "gpt-4"
+                settings.chat_model = "OFFICIAL"
             elif choices.value == "UNOFFICIAL":
-                client.openAI_gpt_engine = "gpt-3.5-turbo"
-                client.chat_model = "UNOFFICIAL"
+                settings.openAI_gpt_engine = "gpt-3.5-turbo"
+                settings.chat_model = "UNOFFICIAL"
             elif choices.value == "UNOFFICIAL-GPT4":
-                client.openAI_gpt_engine = "gpt-4"
-                client.chat_model = "UNOFFICIAL"
+                settings.openAI_gpt_engine = "gpt-4"
+                settings.chat_model = "UNOFFICIAL"
             else:
                 raise ValueError("Invalid choice")
 
-            client.chatbot = client.get_chatbot_model()
-            await interaction.followup.send(f"> **INFO: You are now in {client.chat_model} model.**\n")
-            logger.warning(f"\x1b[31mSwitch to {client.chat_model} model\x1b[0m")
+            # fail early if the related `.env` fields are missing, the guild's conversations are rebuilt lazily
+            client.get_chatbot_model(guild_id=interaction.guild_id)
+            client.sessions.drop_guild(interaction.guild_id)
+            await interaction.followup.send(f"> **INFO: You are now in {settings.chat_model} model.**\n")
+            logger.warning(f"\x1b[31mSwitch to {settings.chat_model} model\x1b[0m")
 
         except Exception as e:
-            client.chat_model = original_chat_model
-            client.openAI_gpt_engine = original_openAI_gpt_engine
-            client.chatbot = client.get_chatbot_model()
+            settings.chat_model = original_chat_model
+            settings.openAI_gpt_engine = original_openAI_gpt_engine
             await interaction.followup.send(f"> **ERROR: Error while switching to the {choices.value} model, check that you've filled in the related fields in `.env`.**\n")
             logger.exception(f"Error while switching to the {choices.value} model: {e}")
 
@@ -288,15 +279,16 @@ def run_discord_bot():
     @client.tree.command(name="reset", description="Complete reset conversation history")
     async def reset(interaction: discord.Interaction):
         await interaction.response.defer(ephemeral=False)
-        if client.chat_model == "OFFICIAL":
-            client.chatbot = client.get_chatbot_model()
-        elif client.chat_model == "UNOFFICIAL":
-            client.chatbot.reset_chat()
-            await client.send_start_prompt()
+        # only the caller's conversation in this channel, the next message starts a fresh one
+        key = conversation_key(interaction)
+        session = client.sessions.peek(key)
+        # an answer still on its way records its turn first, so it lands before the reset marker
+        async with session.lock if session else contextlib.nullcontext():
+            client.sessions.drop(key)
+            client.forget(key)
         await interaction.followup.send("> **INFO: I have forgotten everything.**")
-        personas.current_persona = "standard"
         logger.warning(
-            f"\x1b[31m{client.chat_model} bot has been successfully reset\x1b[0m")
+            f"\x1b[31m{client.settings(interaction.guild_id).chat_model} conversation of {interaction.user} has been successfully reset\x1b[0m")
 
 
     @client.tree.command(name="help", description="Show help for the bot")
@@ -335,25 +327,48 @@ https://github.com/jeffreyliuu/OurGPT""")
     @client.tree.command(name="info", description="Bot information")
     async def info(interaction: discord.Interaction):
         await interaction.response.defer(ephemeral=False)
-        chat_engine_status = client.openAI_gpt_engine
-        chat_model_status = client.chat_model
-        if client.chat_model == "UNOFFICIAL":
+        settings = client.settings(interaction.guild_id)
+        chat_engine_status = settings.openAI_gpt_engine
+        chat_model_status = settings.chat_model
+        if settings.chat_model == "UNOFFICIAL":
             chat_model_status = "ChatGPT(UNOFFICIAL)"
-        elif client.chat_model == "OFFICIAL":
+        elif settings.chat_model == "OFFICIAL":
             chat_model_status = "OpenAI API(OFFICIAL)"
-        if client.chat_model != "UNOFFICIAL" and client.chat_model != "OFFICIAL":
+        if settings.chat_model != "UNOFFICIAL" and settings.chat_model != "OFFICIAL":
             chat_engine_status = "x"
-        elif client.openAI_gpt_engine == "text-davinci-002-render-sha":
+        elif settings.openAI_gpt_engine == "text-davinci-002-render-sha":
             chat_engine_status = "gpt-3.5"
+        queue_stats = client.dispatcher.stats()
+        cache_stats = repository.user_cache.stats()
+        outbound_stats = client.outbox.stats()
+        response_cache_status = "response-cache: off"
+        if client.response_cache:
+            response_stats = client.response_cache.stats()
+            response_cache_status = f"response-cache: {response_stats['hits']} hits / {response_stats['misses']} misses ({response_stats['hit_rate']:.0%}), {response_stats['saved_seconds']:.0f}s saved"
 
         await interaction.followup.send(f"""
 ```fix
 chat-model: {chat_model_status}
 gpt-engine: {chat_engine_status}
+queue-depth: {queue_stats["queue_depth"]}
+workers: {queue_stats["busy"]}/{queue_stats["workers"]} busy ({queue_stats["utilisation"]:.0%})
+sessions: {len(client.sessions)}
+rejected: {client.admission.stats()["rejected"]}
+coalesced: {client.in_flight.saved if client.in_flight else "off"}
+history: {f'{client.history.stats()["restored"]} restored, {client.history.stats()["written"]} turns written' if client.history else "off"}
+outbound: {outbound_stats["sent"]} sent, {outbound_stats["coalesced"]} coalesced, {outbound_stats["retries"]} retries
+preference-cache: {cache_stats["hits"]} hits / {cache_stats["misses"]} misses ({cache_stats["hit_rate"]:.0%})
+{response_cache_status}
 ```
 """)
 
 
+    @client.tree.command(name="metrics", description="Show latency and load metrics")
+    @app_commands.default_permissions(administrator=True)
+    async def show_metrics(interaction: discord.Interaction):
+        await interaction.response.send_message(f"```\n{metrics.summary()[:1900]}\n```", ephemeral=True)
+
+
     @client.tree.command(name="draw", description="Generate an image with the Dalle2 model")
     @app_commands.choices(amount=[
         app_commands.Choice(name="1", value=1),
@@ -376,25 +391,41 @@ gpt-engine: {chat_engine_status}
         logger.info(
             f"\x1b[31m{username}\x1b[0m : /draw [{prompt}] in ({channel})")
 
-        await interaction.response.defer(thinking=True, ephemeral=client.isPrivate)
+        # every followup has to repeat it, only the first one inherits it from the deferred response
+        ephemeral = client.settings(interaction.guild_id).isPrivate
+        await interaction.response.defer(thinking=True, ephemeral=ephemeral)
         try:
-            path = await art.draw(prompt, amount)
-            files = []
-            for idx, img in enumerate(path):
-                files.append(discord.File(img, filename=f"image{idx}.png"))
-            title = f'> **{prompt}** - {str(interaction.user.mention)} \n\n'
-
-            await interaction.followup.send(files=files, content=title)
+            with art.limiter.user(interaction.user.id):
+                position = art.limiter.queue_position()
+                if position:
+                    await interaction.followup.send(f"> **INFO: Your drawing is number {position} in the queue**", ephemeral=ephemeral)
+                title = f'> **{prompt}** - {str(interaction.user.mention)} \n\n'
+
+                # upload each batch as soon as it is ready
+                idx = 0
+                async for images in art.draw_batches(prompt, amount):
+                    files = []
+                    for img in images:
+                        files.append(discord.File(io.BytesIO(img), filename=f"image{idx}.png"))
+                        idx += 1
+                    with metrics.time("draw_upload"):
+                        await client.outbox.send(interaction.channel.id, interaction.followup.send, title, files=files, ephemeral=ephemeral)
+                    title = None
+
+        except art.DrawLimitExceeded:
+            await interaction.followup.send(
+                "> **WARN: You already have a drawing in progress, please wait for it to finish**", ephemeral=ephemeral)
 
         except openai.InvalidRequestError:
             await interaction.followup.send(
-                "> **ERROR: Inappropriate request 😿**")
+                "> **ERROR: Inappropriate request 😿**", ephemeral=ephemeral)
             logger.info(
             f"\x1b[31m{username}\x1b[0m made an inappropriate request.!")
 
         except Exception as e:
+            metrics.error("draw", e)
             await interaction.followup.send(
-                "> **ERROR: Something went wrong 😿**")
+                "> **ERROR: Something went wrong 😿**", ephemeral=ephemeral)
             logger.exception(f"Error while generating image: {e}")
 
 
@@ -424,16 +455,21 @@ gpt-engine: {chat_engine_status}
             f"\x1b[31m{username}\x1b[0m : '/switchpersona [{persona.value}]' ({channel})")
 
         persona = persona.value
+        session = client.sessions.get(conversation_key(interaction))
 
-        if persona == personas.current_persona:
+        if persona == session.persona:
             await interaction.followup.send(f"> **WARN: Already set to `{persona}` persona**")
 
         elif persona == "standard":
-            if client.chat_model == "OFFICIAL":
-                client.chatbot.reset()
-            elif client.chat_model == "UNOFFICIAL":
-                client.chatbot.reset_chat()
-            personas.current_persona = "standard"
+            chat_model = client.settings(interaction.guild_id).chat_model
+            async with session.lock:
+                if chat_model == "OFFICIAL":
+                    session.chatbot.reset()
+                elif chat_model == "UNOFFICIAL":
+                    session.chatbot.reset_chat()
+                    session.primed = False
+                session.persona = "standard"
+                client.forget(session.key)
             await interaction.followup.send(
                 f"> **INFO: Switched to `{persona}` persona**")
 
@@ -441,16 +477,14 @@ gpt-engine: {chat_engine_status}
             choices = list(personas.PERSONAS.keys())
             choice = randrange(0, 6)
             chosen_persona = choices[choice]
-            personas.current_persona = chosen_persona
-            await responses.switch_persona(chosen_persona, client)
+            await responses.switch_persona(chosen_persona, client, session)
             await interaction.followup.send(
                 f"> **INFO: Switched to `{chosen_persona}` persona**")
 
 
         elif persona in personas.PERSONAS:
             try:
-                await responses.switch_persona(persona, client)
-                personas.current_persona = persona
+                await responses.switch_persona(persona, client, session)
                 await interaction.followup.send(
                 f"> **INFO: Switched to `{persona}` persona**")
             except Exception as e:
@@ -467,20 +501,25 @@ gpt-engine: {chat_engine_status}
 
     @client.event
     async def on_message(message):
-        if client.is_replying_all == "True":
+        settings = client.settings(message.guild.id if message.guild else None)
+        if settings.is_replying_all == "True":
             if message.author == client.user:
                 return
-            if client.replying_all_discord_channel_id:
-                if message.channel.id == int(client.replying_all_discord_channel_id):
+            if settings.replying_all_discord_channel_id:
+                if message.channel.id == int(settings.replying_all_discord_channel_id):
                     username = str(message.author)
                     user_message = str(message.content)
-                    client.current_channel = message.channel
-                    logger.info(f"\x1b[31m{username}\x1b[0m : '{user_message}' ({client.current_channel})")
+                    logger.info(f"\x1b[31m{username}\x1b[0m : '{user_message}' ({message.channel})")
 
                     await client.enqueue_message(message, user_message)
             else:
                 logger.exception("replying_all_discord_channel_id not found, please use the command `/replyall` again.")
 
+
+
+def run_discord_bot():
+    setup_bot()
+
     TOKEN = os.getenv("DISCORD_BOT_TOKEN")
 
-    client.run(TOKEN)
\ No newline at end of file
+    client.run(TOKEN)
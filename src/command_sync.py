@@ -0,0 +1,65 @@
+"""
+Module responsible for uploading the slash commands only when they changed
+
+Syncing the command tree re-uploads every command definition and Discord
+rate limits it tightly. The definitions are hashed instead, and the hash of
+the last successful sync is kept per application and scope (global or one
+guild) in COMMAND_SYNC_CACHE. A restart or reconnect with the same commands
+then skips the upload. COMMAND_SYNC_FORCE=True syncs regardless.
+"""
+import os
+import json
+import hashlib
+
+from discord import app_commands
+
+from src.log import logger
+
+CACHE_PATH = os.getenv("COMMAND_SYNC_CACHE", os.path.abspath(f"{__file__}/../../.command-sync.json"))
+
+
+def tree_fingerprint(tree: app_commands.CommandTree, guild=None) -> str:
+    commands = sorted(
+        (command.to_dict() for command in tree.get_commands(guild=guild)),
+        key=lambda command: (command["name"], command.get("type", 1)),
+    )
+    payload = json.dumps(commands, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def _load() -> dict:
+    try:
+        with open(CACHE_PATH, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save(fingerprints: dict) -> None:
+    # written to a temporary file first so a crash never leaves half a file behind
+    temporary = f"{CACHE_PATH}.tmp"
+    with open(temporary, "w", encoding="utf-8") as f:
+        json.dump(fingerprints, f, indent=2, sort_keys=True)
+    os.replace(temporary, CACHE_PATH)
+
+
+# True when the commands were uploaded, False when Discord already had them
+async def sync_commands(tree: app_commands.CommandTree, guild=None, force: bool = None) -> bool:
+    if force is None:
+        force = os.getenv("COMMAND_SYNC_FORCE", "False") == "True"
+    scope = f"{tree.client.application_id}:{f'guild:{guild.id}' if guild else 'global'}"
+    fingerprint = tree_fingerprint(tree, guild)
+    fingerprints = _load()
+
+    if not force and fingerprints.get(scope) == fingerprint:
+        logger.info(f"Commands for {scope} are unchanged, skipping sync")
+        return False
+
+    await tree.sync(guild=guild)
+    fingerprints[scope] = fingerprint
+    try:
+        _save(fingerprints)
+    except OSError as e:
+        logger.warning(f"Could not store the command fingerprint, the next start will sync again: {e}")
+    logger.info(f"Synced {len(tree.get_commands(guild=guild))} commands for {scope}")
+    return True
@@ -0,0 +1,116 @@
+"""
+Module responsible for keeping conversation history within a token budget
+
+Before each OFFICIAL request the history is measured. Once it would pass
+CONTEXT_TOKEN_BUDGET, everything but the system prompt and the most recent
+messages is folded into a short summary, or simply dropped when summaries are
+turned off. It is cut down to CONTEXT_LOW_WATER of the budget (60% by
+default) rather than to just under it, so the summary request is paid for
+once every several turns instead of on nearly every one. The prompt sent per
+request then stays roughly the same size however long a conversation runs. UNOFFICIAL keeps its history on the
+website, so there is nothing to manage there.
+"""
+import os
+import asyncio
+
+from asgiref.sync import sync_to_async
+
+from src.log import logger
+
+# scratch conversation used for summaries so they never leak into the real history
+SUMMARY_CONVO_ID = "summary"
+SUMMARY_PROMPT = "Summarise the following conversation in a few sentences. Keep names, facts, preferences and open questions, leave out small talk."
+SUMMARY_PREFIX = "Summary of the earlier conversation: "
+# room left for the summary when deciding how many recent messages to keep
+SUMMARY_TOKENS = 200
+
+_encoding = None
+
+
+def count_tokens(text: str) -> int:
+    global _encoding
+    if _encoding is None:
+        try:
+            import tiktoken
+            _encoding = tiktoken.get_encoding("cl100k_base")
+        except Exception:
+            # no tiktoken or no cached encoding, about four characters to a token
+            _encoding = False
+    if not _encoding:
+        return len(text) // 4 + 1
+    return len(_encoding.encode(text, disallowed_special=()))
+
+
+def count_conversation(turns: list[dict]) -> int:
+    # every message carries a few tokens of framing on top of its content
+    return sum(count_tokens(turn["content"] or "") + 4 for turn in turns)
+
+
+class ContextWindow:
+    """Trims or summarises a chatbot's history to fit the budget"""
+
+    def __init__(self, budget: int = None, keep_messages: int = None, summarise: bool = None) -> None:
+        self.budget = budget or int(os.getenv("CONTEXT_TOKEN_BUDGET", 2500))
+        self.keep_messages = keep_messages or int(os.getenv("CONTEXT_KEEP_MESSAGES", 6))
+        self.low_water = float(os.getenv("CONTEXT_LOW_WATER", 0.6))
+        self.summarise = summarise if summarise is not None else os.getenv("CONTEXT_SUMMARY", "True") == "True"
+        self.summaries = 0
+        self.trimmed = 0
+
+    # loads the encoding at startup and off the event loop, the first load reads or even downloads it
+    async def warm_up(self) -> None:
+        await asyncio.to_thread(count_tokens, "")
+
+    async def fit(self, chatbot, prompt: str) -> None:
+        conversation = getattr(chatbot, "conversation", None)
+        if not isinstance(conversation, dict) or not conversation.get("default"):
+            return
+        turns = conversation["default"]
+        prompt_tokens = count_tokens(prompt)
+        if count_conversation(turns) + prompt_tokens <= self.budget:
+            return
+
+        # turns[0] is the starting prompt or persona and always stays
+        system, history = turns[0], turns[1:]
+        target = int(self.budget * self.low_water)
+        # the most recent messages, up to keep_messages of them, that fit under the low-water mark
+        room = target - count_conversation([system]) - prompt_tokens - (SUMMARY_TOKENS if self.summarise else 0)
+        keep = 0
+        for turn in reversed(history[-self.keep_messages:]):
+            room -= count_conversation([turn])
+            if room < 0:
+                break
+            keep += 1
+        older, recent = history[:len(history) - keep], history[len(history) - keep:]
+        fitted = [system]
+        if older and self.summarise:
+            try:
+                summary = await self._summarise(chatbot, older)
+                fitted.append({"role": "system", "content": f"{SUMMARY_PREFIX}{summary}"})
+                self.summaries += 1
+            except Exception as e:
+                logger.exception(f"Error while summarising conversation, trimming instead: {e}")
+        fitted += recent
+
+        # still over the mark, e.g. a long summary, drop the oldest messages after the system prompt and summary
+        first = 2 if len(fitted) > 1 and fitted[1]["content"].startswith(SUMMARY_PREFIX) else 1
+        while len(fitted) > first + 1 and count_conversation(fitted) + prompt_tokens > target:
+            del fitted[first]
+
+        self.trimmed += len(turns) - len(fitted)
+        turns[:] = fitted
+
+    async def _summarise(self, chatbot, turns: list[dict]) -> str:
+        transcript = "\n".join(f"{turn['role']}: {turn['content']}" for turn in turns)
+        # the summary request itself has to fit too
+        transcript = transcript[-self.budget * 4:]
+        chatbot.reset(convo_id=SUMMARY_CONVO_ID, system_prompt=SUMMARY_PROMPT)
+        try:
+            if asyncio.iscoroutinefunction(chatbot.ask):
+                return await chatbot.ask(transcript, convo_id=SUMMARY_CONVO_ID)
+            return await sync_to_async(chatbot.ask, thread_sensitive=False)(transcript, convo_id=SUMMARY_CONVO_ID)
+        finally:
+            chatbot.conversation.pop(SUMMARY_CONVO_ID, None)
+
+    def stats(self) -> dict:
+        return {"summaries": self.summaries, "trimmed": self.trimmed}
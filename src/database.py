@@ -0,0 +1,460 @@
+"""
+Module responsible for all MongoDB access
+
+pymongo is synchronous, so every operation runs on a small bounded thread pool
+sharing one pooled MongoClient and is awaited with a timeout. This keeps the
+Discord gateway heartbeat alive whatever the database is doing.
+
+Setting MONGO_BACKEND=memory swaps MongoDB for an in-memory stand-in with the
+same interface, so the bot can run without a Mongo server. The stand-in keeps
+indexes as metadata and enforces the unique ones, TTL indexes never expire
+anything there.
+
+The schema itself is managed by src/migrations.py, applied at startup.
+
+Preference documents are cached per process for PREFERENCE_CACHE_TTL seconds.
+A write only clears the cache of the process that made it, so with the shards
+spread over several processes (see main.py) another process can serve a
+user's old preferences for up to that long. The launcher lowers the TTL to
+PREFERENCE_CACHE_TTL_SHARDED (10 seconds by default) unless it is set.
+"""
+import os
+import re
+import copy
+import operator
+import asyncio
+import threading
+import functools
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from bson import ObjectId
+from pymongo import MongoClient, ASCENDING, DESCENDING
+from pymongo.errors import DuplicateKeyError
+from pymongo.results import InsertOneResult, InsertManyResult, UpdateResult, DeleteResult
+
+from src.log import logger
+from src.cache import LRUCache
+from src import migrations
+
+# distinguishes a cache miss from a cached "not registered"
+_UNCACHED = object()
+
+# only the fields the bot reads, the rest of a preference document stays on the server
+USER_FIELDS = {"_id": 0, "username": 1, "preferences": 1}
+LIST_FIELDS = {"_id": 0, "username": 1, "register_date": 1}
+
+_COMPARISONS = {"$gt": operator.gt, "$gte": operator.ge, "$lt": operator.lt, "$lte": operator.le}
+
+
+# MongoDB orders null and missing fields before any value
+def _order(value):
+    return (0,) if value is None else (1, value)
+
+
+class MemoryCollection:
+    """The subset of pymongo's Collection API the bot uses, kept in a list"""
+
+    def __init__(self) -> None:
+        self._documents: list[dict] = []
+        self._indexes: dict[str, dict] = {"_id_": {"key": [("_id", ASCENDING)]}}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _test(document: dict, field: str, op: str, argument) -> bool:
+        if op == "$exists":
+            return (field in document) == bool(argument)
+        if op == "$in":
+            return document.get(field) in argument
+        if op == "$regex":
+            return isinstance(document.get(field), str) and re.search(argument, document[field]) is not None
+        return _COMPARISONS[op](_order(document.get(field)), _order(argument))
+
+    @classmethod
+    def _matches(cls, document: dict, filter: dict) -> bool:
+        for field, value in (filter or {}).items():
+            if field == "$or":
+                if not any(cls._matches(document, alternative) for alternative in value):
+                    return False
+            elif isinstance(value, dict) and all(op.startswith("$") for op in value):
+                if not all(cls._test(document, field, op, argument) for op, argument in value.items()):
+                    return False
+            elif document.get(field) != value:
+                return False
+        return True
+
+    def _check_unique(self, documents: list[dict]) -> None:
+        for name, index in self._indexes.items():
+            # like MongoDB, _id is always unique
+            if not index.get("unique") and name != "_id_":
+                continue
+            fields = [field for field, _ in index["key"]]
+            seen = {tuple(d.get(field) for field in fields) for d in self._documents}
+            for document in documents:
+                key = tuple(document.get(field) for field in fields)
+                if key in seen:
+                    raise DuplicateKeyError(f"E11000 duplicate key error index: {name} dup key: {key}")
+                seen.add(key)
+
+    def create_index(self, keys, name: str = None, unique: bool = False, **kwargs) -> str:
+        keys = [(keys, ASCENDING)] if isinstance(keys, str) else list(keys)
+        name = name or "_".join(f"{field}_{direction}" for field, direction in keys)
+        with self._lock:
+            if name not in self._indexes:
+                index = {"key": keys, **({"unique": True} if unique else {}), **kwargs}
+                if unique:
+                    self._indexes[name] = index
+                    try:
+                        self._check_unique([])
+                    except DuplicateKeyError:
+                        del self._indexes[name]
+                        raise
+                self._indexes[name] = index
+        return name
+
+    def index_information(self) -> dict:
+        with self._lock:
+            return copy.deepcopy(self._indexes)
+
+    def drop_index(self, name: str) -> None:
+        with self._lock:
+            del self._indexes[name]
+
+    @staticmethod
+    def _project(document: dict, projection: dict) -> dict:
+        if not projection:
+            return copy.deepcopy(document)
+        if not any(wanted for field, wanted in projection.items() if field != "_id"):
+            # only exclusions
+            return {field: copy.deepcopy(value) for field, value in document.items() if projection.get(field, 1)}
+        projected = {field: copy.deepcopy(document[field]) for field, wanted in projection.items() if wanted and field in document}
+        if projection.get("_id", 1):
+            projected["_id"] = document["_id"]
+        return projected
+
+    def find_one(self, filter: dict = None, projection: dict = None):
+        with self._lock:
+            for document in self._documents:
+                if self._matches(document, filter):
+                    return self._project(document, projection)
+        return None
+
+    def find(self, filter: dict = None, projection: dict = None, sort: list = None, skip: int = 0, limit: int = 0, batch_size: int = 0) -> list[dict]:
+        with self._lock:
+            documents = [d for d in self._documents if self._matches(d, filter)]
+            # stable sorts, least significant key first
+            for field, direction in reversed(sort or []):
+                documents.sort(key=lambda d: _order(d.get(field)), reverse=direction == DESCENDING)
+            documents = documents[skip:skip + limit if limit else None]
+            return [self._project(d, projection) for d in documents]
+
+    def insert_one(self, document: dict) -> InsertOneResult:
+        document.setdefault("_id", ObjectId())
+        with self._lock:
+            self._check_unique([document])
+            self._documents.append(copy.deepcopy(document))
+        return InsertOneResult(document["_id"], True)
+
+    def insert_many(self, documents: list[dict], ordered: bool = True) -> InsertManyResult:
+        for document in documents:
+            document.setdefault("_id", ObjectId())
+        with self._lock:
+            self._check_unique(documents)
+            self._documents.extend(copy.deepcopy(documents))
+        return InsertManyResult([d["_id"] for d in documents], True)
+
+    # a "$field" reference or {"$toDate": "$_id"}, the only aggregation expressions the bot uses
+    @staticmethod
+    def _evaluate(document: dict, expression):
+        if isinstance(expression, str) and expression.startswith("$"):
+            return document.get(expression[1:])
+        if isinstance(expression, dict) and "$toDate" in expression:
+            value = MemoryCollection._evaluate(document, expression["$toDate"])
+            return value.generation_time if isinstance(value, ObjectId) else value
+        return expression
+
+    # applies an update document, or a pipeline of $set stages, and tells whether anything changed
+    def _update(self, document: dict, update) -> bool:
+        before = copy.deepcopy(document)
+        if isinstance(update, list):
+            for stage in update:
+                document.update({field: self._evaluate(document, value) for field, value in stage["$set"].items()})
+            return document != before
+        document.update(update.get("$set", {}))
+        for field, value in update.get("$addToSet", {}).items():
+            values = value["$each"] if isinstance(value, dict) and "$each" in value else [value]
+            current = document.setdefault(field, [])
+            current.extend(v for v in values if v not in current)
+        return document != before
+
+    def update_one(self, filter: dict, update) -> UpdateResult:
+        with self._lock:
+            for document in self._documents:
+                if self._matches(document, filter):
+                    modified = int(self._update(document, update))
+                    return UpdateResult({"n": 1, "nModified": modified}, True)
+        return UpdateResult({"n": 0, "nModified": 0}, True)
+
+    def update_many(self, filter: dict, update) -> UpdateResult:
+        with self._lock:
+            matched = [d for d in self._documents if self._matches(d, filter)]
+            modified = sum(self._update(document, update) for document in matched)
+        return UpdateResult({"n": len(matched), "nModified": modified}, True)
+
+    def delete_one(self, filter: dict) -> DeleteResult:
+        with self._lock:
+            for index, document in enumerate(self._documents):
+                if self._matches(document, filter):
+                    del self._documents[index]
+                    return DeleteResult({"n": 1}, True)
+        return DeleteResult({"n": 0}, True)
+
+    def delete_many(self, filter: dict) -> DeleteResult:
+        with self._lock:
+            kept = [d for d in self._documents if not self._matches(d, filter)]
+            deleted = len(self._documents) - len(kept)
+            self._documents = kept
+        return DeleteResult({"n": deleted}, True)
+
+
+class MemoryDatabase:
+    """Stand-in for a pymongo Database handing out MemoryCollections"""
+
+    def __init__(self) -> None:
+        self._collections: dict[str, MemoryCollection] = {}
+
+    def __getitem__(self, name: str) -> MemoryCollection:
+        return self._collections.setdefault(name, MemoryCollection())
+
+    def command(self, name: str, value=None, **kwargs) -> dict:
+        if name == "collMod":
+            index = kwargs["index"]
+            with self[value]._lock:
+                self[value]._indexes[index["name"]]["expireAfterSeconds"] = index["expireAfterSeconds"]
+        return {"ok": 1.0}
+
+
+class Repository:
+    """Async access to the preferences, interactions and conversations collections"""
+
+    def __init__(self, db, workers: int = None, timeout: float = None) -> None:
+        self.db = db
+        self.preferences = db["preferences"]
+        self.interactions = db["interactions"]
+        self.conversations = db["conversations"]
+        # read-through cache of preference documents, kept in sync by the write methods below
+        self.user_cache = LRUCache(
+            maxsize=int(os.getenv("PREFERENCE_CACHE_SIZE", 4096)),
+            ttl=float(os.getenv("PREFERENCE_CACHE_TTL", 300)),
+        )
+        # username -> [reads in flight, invalidations since the first of them], only kept while reads are running
+        self._reads: dict[str, list] = {}
+        self.timeout = timeout or float(os.getenv("MONGO_TIMEOUT", 5))
+        self.workers = workers or int(os.getenv("MONGO_WORKERS", 4))
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="mongo")
+
+    async def _run(self, fn, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        call = functools.partial(fn, *args, **kwargs)
+        return await asyncio.wait_for(loop.run_in_executor(self._executor, call), self.timeout)
+
+    # pymongo connects lazily, one ping per worker opens the pool's connections ahead of the first command
+    async def warm_up(self) -> None:
+        await asyncio.gather(*(self._run(self.db.command, "ping") for _ in range(self.workers)))
+
+    async def migrate(self) -> None:
+        # building an index on a large collection can take a while, so no timeout here
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self._executor, migrations.apply, self.db)
+
+    def _invalidate(self, username: str) -> None:
+        if username in self._reads:
+            self._reads[username][1] += 1
+        self.user_cache.pop(username)
+
+    async def find_user(self, username: str):
+        user = self.user_cache.get(username, _UNCACHED)
+        if user is _UNCACHED:
+            reads = self._reads.setdefault(username, [0, 0])
+            reads[0] += 1
+            generation = reads[1]
+            try:
+                user = await self._run(self.preferences.find_one, {"username": username}, USER_FIELDS)
+            finally:
+                reads[0] -= 1
+                if not reads[0]:
+                    del self._reads[username]
+            # a write while this was being read may have made it stale
+            if reads[1] == generation:
+                # unregistered users are cached as None so /chat skips the lookup for them too
+                self.user_cache.set(username, user)
+        return user
+
+    # raises DuplicateKeyError when the username is already registered
+    async def register_user(self, document: dict) -> bool:
+        self._invalidate(document["username"])
+        result = await self._run(self.preferences.insert_one, document)
+        self._invalidate(document["username"])
+        if result.acknowledged:
+            self.user_cache.set(document["username"], {field: document.get(field) for field in USER_FIELDS if field != "_id"})
+        return result.acknowledged
+
+    async def delete_user(self, username: str) -> int:
+        self._invalidate(username)
+        result = await self._run(self.preferences.delete_one, {"username": username})
+        self._invalidate(username)
+        self.user_cache.set(username, None)
+        return result.deleted_count
+
+    async def add_preferences(self, username: str, preferences: list[str]) -> int:
+        self._invalidate(username)
+        result = await self._run(
+            self.preferences.update_one,
+            {"username": username},
+            {"$addToSet": {"preferences": {"$each": preferences}}},
+        )
+        # the next read fetches the merged document
+        self._invalidate(username)
+        return result.modified_count
+
+    # One page of users, sorted by username or by registration (the ObjectId, which is indexed and
+    # unique). `after`/`before` are the sort key of the last/first user of the page already shown,
+    # so the query starts right there in the index instead of skipping everything before it.
+    async def list_users(self, limit: int, sort: str = "username", descending: bool = False, prefix: str = None,
+                         after=None, before=None, skip: int = 0) -> list[dict]:
+        field = "username" if sort == "username" else "_id"
+        direction = DESCENDING if descending else ASCENDING
+        filter = {}
+        if prefix:
+            # anchored and case sensitive, so it is answered from the username index
+            filter["username"] = {"$regex": f"^{re.escape(prefix)}"}
+        if after is not None:
+            filter.setdefault(field, {})["$lt" if descending else "$gt"] = after
+        if before is not None:
+            # walks backwards from the first user shown, the page is flipped back below
+            filter.setdefault(field, {})["$gt" if descending else "$lt"] = before
+            direction = -direction
+        projection = {**LIST_FIELDS, "_id": int(field == "_id")}
+
+        # the cursor is drained on the executor too, iterating it lazily would block the loop
+        users = await self._run(lambda: list(self.preferences.find(
+            filter, projection, sort=[(field, direction)], skip=skip, limit=limit, batch_size=limit)))
+        return users[::-1] if before is not None else users
+
+    async def log_interactions(self, documents: list[dict]) -> None:
+        # unordered so one bad document does not stop the rest of the batch
+        await self._run(self.interactions.insert_many, documents, ordered=False)
+
+    async def log_turns(self, documents: list[dict]) -> None:
+        # ordered, a conversation's turns have to be stored in the order they happened
+        await self._run(self.conversations.insert_many, documents)
+
+    # the latest records of a conversation, newest first, in the order they were inserted
+    async def conversation_records(self, key: tuple, limit: int) -> list[dict]:
+        guild, channel, user = key
+        return await self._run(lambda: list(self.conversations.find(
+            {"guild": guild, "channel": channel, "user": user},
+            {"_id": 0, "persona": 1, "prompt": 1, "answer": 1, "reset": 1},
+            sort=[("_id", DESCENDING)], limit=limit, batch_size=limit)))
+
+    async def delete_conversations(self, user_id: int) -> int:
+        result = await self._run(self.conversations.delete_many, {"user": user_id})
+        return result.deleted_count
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=False)
+
+
+class InteractionWriter:
+    """Write-behind buffer flushing interaction records with insert_many
+
+    A batch goes out once batch_size records are waiting or every interval
+    seconds, whichever comes first. When the buffer is full the oldest
+    records are dropped rather than holding up /chat. `write` swaps the
+    interactions collection for another one, e.g. Repository.log_turns.
+    """
+
+    def __init__(self, repository: Repository, batch_size: int = None, interval: float = None, max_buffer: int = None,
+                 write=None, name: str = "interactions") -> None:
+        self.repository = repository
+        self.write = write or repository.log_interactions
+        self.name = name
+        self.batch_size = batch_size or int(os.getenv("INTERACTION_BATCH_SIZE", 100))
+        self.interval = interval or float(os.getenv("INTERACTION_FLUSH_INTERVAL", 5))
+        self._buffer = deque(maxlen=max_buffer or int(os.getenv("INTERACTION_BUFFER_SIZE", 10000)))
+        self._wakeup = asyncio.Event()
+        # one flush at a time, so batches are written in order and a flush returns once everything before it is stored
+        self._flushing = asyncio.Lock()
+        # the batch being written, no longer in the buffer but not stored yet either
+        self._batch = []
+        self._task = None
+        self._closing = False
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    def add(self, record: dict) -> None:
+        if len(self._buffer) == self._buffer.maxlen:
+            self.dropped += 1
+        self._buffer.append(record)
+        if len(self._buffer) >= self.batch_size:
+            self._wakeup.set()
+
+    async def _run(self) -> None:
+        while not self._closing:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    async def flush(self) -> None:
+        async with self._flushing:
+            while self._buffer:
+                batch = self._batch = [self._buffer.popleft() for _ in range(min(self.batch_size, len(self._buffer)))]
+                try:
+                    await self.write(batch)
+                    self.written += len(batch)
+                except Exception as e:
+                    self.failed += len(batch)
+                    logger.exception(f"Error while writing {len(batch)} {self.name}: {e}")
+                    return
+                finally:
+                    self._batch = []
+
+    # whether any record matching `match` is still waiting to be stored
+    def pending(self, match) -> bool:
+        return any(match(record) for record in self._batch) or any(match(record) for record in self._buffer)
+
+    async def close(self) -> None:
+        # let the running flush finish instead of cancelling it halfway through a batch
+        self._closing = True
+        self._wakeup.set()
+        if self._task is not None:
+            await self._task
+            self._task = None
+        await self.flush()
+
+    def stats(self) -> dict:
+        return {"buffered": len(self._buffer), "written": self.written, "dropped": self.dropped, "failed": self.failed}
+
+
+def connect() -> Repository:
+    if os.getenv("MONGO_BACKEND") == "memory":
+        logger.info("Using the in-memory database")
+        return Repository(MemoryDatabase())
+
+    timeout_ms = int(float(os.getenv("MONGO_CONNECT_TIMEOUT", 5)) * 1000)
+    mongo_client = MongoClient(
+        os.getenv("MONGO_URI", "mongodb://host.docker.internal:27017"),
+        maxPoolSize=int(os.getenv("MONGO_POOL_SIZE", 20)),
+        connectTimeoutMS=timeout_ms,
+        serverSelectionTimeoutMS=timeout_ms,
+        socketTimeoutMS=int(float(os.getenv("MONGO_TIMEOUT", 5)) * 1000),
+    )
+    return Repository(mongo_client[os.getenv("MONGO_DB", "ourgpt_development")])
@@ -0,0 +1,194 @@
+"""
+Module responsible for dispatching queued chat messages to a pool of workers
+
+Messages are pulled from the queue as soon as they arrive and handed to one of
+N concurrent workers. Messages that belong to the same conversation are still
+answered in the order they were sent.
+
+The queue is fair rather than first come first served: every user (or channel)
+has their own sub-queue and the sub-queues take turns, and interactive slash
+commands get more turns than replyall traffic.
+"""
+import os
+import time
+import asyncio
+import contextlib
+from collections import deque, OrderedDict
+
+import discord
+
+from src.log import logger
+
+
+# slash commands hand us an Interaction (.user), replyall hands us a Message (.author)
+def message_author(message):
+    return getattr(message, "user", None) or message.author
+
+
+def conversation_key(message) -> tuple:
+    guild_id = message.guild.id if message.guild else None
+    return (guild_id, message.channel.id, message_author(message).id)
+
+
+class ChatRequest:
+    """A single queued chat message and its bookkeeping"""
+
+    def __init__(self, message, user_message: str, original: str = None, use_cache: bool = True, priority: str = "interactive") -> None:
+        self.message = message
+        self.user_message = user_message
+        # what the user actually typed, user_message may carry their preferences too
+        self.original = original or user_message
+        self.use_cache = use_cache
+        self.priority = priority
+        self.key = conversation_key(message)
+        self.enqueued_at = time.monotonic()
+        self.started_at = None
+
+
+class FairQueue:
+    """Weighted round robin over priority classes, and plain round robin over the users within a class"""
+
+    def __init__(self, weights: dict = None, fair_key: str = None) -> None:
+        self.weights = weights or {
+            "interactive": int(os.getenv("CHAT_INTERACTIVE_WEIGHT", 3)),
+            "replyall": int(os.getenv("CHAT_REPLYALL_WEIGHT", 1)),
+        }
+        # a class with no turns would never be served, and get() would spin forever looking for one
+        for name, weight in self.weights.items():
+            if weight < 1:
+                raise ValueError(f"The weight of {name} messages must be at least 1, got {weight}")
+        # "user" or "channel", whose sub-queues take turns
+        self.fair_key = fair_key or os.getenv("CHAT_FAIR_KEY", "user")
+        self._classes: dict[str, OrderedDict] = {name: OrderedDict() for name in self.weights}
+        self._order = deque(self.weights)
+        self._served = 0
+        self._items = asyncio.Semaphore(0)
+        self._size = 0
+
+    def qsize(self) -> int:
+        return self._size
+
+    def put_nowait(self, request: ChatRequest) -> None:
+        owner = request.key[1] if self.fair_key == "channel" else request.key[2]
+        self._classes[request.priority].setdefault(owner, deque()).append(request)
+        self._size += 1
+        self._items.release()
+
+    async def get(self) -> ChatRequest:
+        await self._items.acquire()
+        self._size -= 1
+        # a class keeps its turn for `weight` messages, or until it runs dry
+        while True:
+            name = self._order[0]
+            owners = self._classes[name]
+            if owners and self._served < self.weights[name]:
+                break
+            self._order.rotate(-1)
+            self._served = 0
+        self._served += 1
+
+        owner, requests = next(iter(owners.items()))
+        request = requests.popleft()
+        # the owner goes to the back of the line, or leaves it when they have nothing else queued
+        del owners[owner]
+        if requests:
+            owners[owner] = requests
+        return request
+
+
+class MessageDispatcher:
+    """Pool of workers blocking on the message queue
+
+    `on_error(request, error)` answers a request that failed and `on_done(request)`
+    runs once every request is over, whether it succeeded or not.
+    """
+
+    def __init__(self, handler, workers: int = None, on_error=None, on_done=None) -> None:
+        self.handler = handler
+        self.on_error = on_error
+        self.on_done = on_done
+        self.workers = workers or int(os.getenv("CHAT_WORKERS", 4))
+        self.queue = FairQueue()
+        # conversation key -> requests waiting behind the one being answered
+        self._pending: dict[tuple, deque] = {}
+        self._tasks: list[asyncio.Task] = []
+        self.busy = 0
+        self.processed = 0
+        self.failed = 0
+        # moving average of how long one message takes, used to tell rejected users when to come back
+        self.avg_service = 0.0
+
+    def start(self) -> None:
+        if self._tasks:
+            return
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        logger.info(f"Started {self.workers} message workers")
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def put(self, request: ChatRequest) -> None:
+        self.queue.put_nowait(request)
+
+    async def _worker(self) -> None:
+        while True:
+            request = await self.queue.get()
+            key = request.key
+            if key in self._pending:
+                # another worker is answering this conversation, it will pick this up next
+                self._pending[key].append(request)
+                continue
+
+            self._pending[key] = backlog = deque()
+            self.busy += 1
+            try:
+                while request is not None:
+                    await self._run(request)
+                    request = backlog.popleft() if backlog else None
+            finally:
+                self.busy -= 1
+                del self._pending[key]
+
+    async def _run(self, request: ChatRequest) -> None:
+        request.started_at = time.monotonic()
+        try:
+            async with contextlib.AsyncExitStack() as stack:
+                # only a courtesy, a channel the bot cannot type in still gets its answer
+                try:
+                    await stack.enter_async_context(request.message.channel.typing())
+                except discord.HTTPException as e:
+                    logger.warning(f"Could not show the typing indicator: {e}")
+                await self.handler(request)
+            self.processed += 1
+        except Exception as e:
+            self.failed += 1
+            logger.exception(f"Error while processing message: {e}")
+            if self.on_error:
+                try:
+                    await self.on_error(request, e)
+                except Exception as e:
+                    logger.exception(f"Error while reporting a failed message: {e}")
+        finally:
+            self.avg_service += (time.monotonic() - request.started_at - self.avg_service) * 0.2
+            if self.on_done:
+                self.on_done(request)
+
+    def depth(self) -> int:
+        return self.queue.qsize() + sum(len(backlog) for backlog in self._pending.values())
+
+    # rough time until a message queued now would start
+    def estimated_wait(self) -> float:
+        return self.depth() / self.workers * self.avg_service
+
+    def stats(self) -> dict:
+        return {
+            "queue_depth": self.depth(),
+            "workers": self.workers,
+            "busy": self.busy,
+            "utilisation": self.busy / self.workers,
+            "processed": self.processed,
+            "failed": self.failed,
+        }
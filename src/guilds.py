@@ -0,0 +1,19 @@
+"""
+Module responsible for the settings each guild can change for itself
+
+/private, /public, /replyall and /chat-model only affect the guild they are
+used in. A guild is always served by the same shard, and so by the same
+process, so each process only ever holds the settings of its own guilds and
+nothing has to be shared between processes. Every guild starts from the
+defaults in `.env`.
+"""
+import os
+
+
+class GuildSettings:
+    def __init__(self) -> None:
+        self.isPrivate = False
+        self.is_replying_all = os.getenv("REPLYING_ALL", "False")
+        self.replying_all_discord_channel_id = os.getenv("REPLYING_ALL_DISCORD_CHANNEL_ID")
+        self.chat_model = os.getenv("CHAT_MODEL")
+        self.openAI_gpt_engine = os.getenv("GPT_ENGINE")
@@ -0,0 +1,84 @@
+"""
+Module responsible for keeping conversations across restarts
+
+Every answered turn is appended to the `conversations` collection as a record
+of its own, through the same kind of write-behind buffer as the interaction
+log. /reset and persona switches append a marker instead of deleting
+anything. Nothing is loaded at startup: a conversation is rebuilt from its
+records the first time it is used again, after a restart, an eviction or a
+/chat-model switch, so restarts stay fast and memory only holds the
+conversations in use.
+
+Only OFFICIAL keeps its history locally and gets it replayed. UNOFFICIAL
+conversations live on the ChatGPT website, their turns are still recorded so
+a guild switching to OFFICIAL carries on from them.
+"""
+import os
+from datetime import datetime
+
+from src.database import InteractionWriter, Repository
+
+
+class ConversationHistory:
+    """Append-only per-turn records of every conversation"""
+
+    def __init__(self, repository: Repository, restore_turns: int = None, interval: float = None) -> None:
+        self.repository = repository
+        # the context window trims whatever does not fit, this only bounds the read
+        self.restore_turns = restore_turns or int(os.getenv("CONVERSATION_RESTORE_TURNS", 50))
+        self.writer = InteractionWriter(
+            repository,
+            interval=interval or float(os.getenv("CONVERSATION_FLUSH_INTERVAL", 1)),
+            write=repository.log_turns,
+            name="conversation turns",
+        )
+        self.restored = 0
+
+    def start(self) -> None:
+        self.writer.start()
+
+    async def close(self) -> None:
+        await self.writer.close()
+
+    def _add(self, key: tuple, persona: str, **fields) -> None:
+        guild, channel, user = key
+        self.writer.add({
+            "guild": guild,
+            "channel": channel,
+            "user": user,
+            "persona": persona,
+            **fields,
+            "timestamp": datetime.utcnow(),
+        })
+
+    def record(self, key: tuple, persona: str, prompt: str, answer: str) -> None:
+        self._add(key, persona, prompt=prompt, answer=answer)
+
+    # turns before a reset are never restored
+    def reset(self, key: tuple, persona: str = "standard") -> None:
+        self._add(key, persona, reset=True)
+
+    # the persona and the (prompt, answer) turns since the last reset, oldest first
+    async def load(self, key: tuple) -> tuple[str, list[tuple[str, str]]]:
+        # only waits for the other conversations' records when this one has some of its own waiting
+        if self.writer.pending(lambda record: (record["guild"], record["channel"], record["user"]) == key):
+            await self.writer.flush()
+        records = await self.repository.conversation_records(key, self.restore_turns)
+        persona = records[0].get("persona", "standard") if records else "standard"
+        turns = []
+        for record in records:
+            if record.get("reset"):
+                break
+            turns.append((record["prompt"], record["answer"]))
+        if turns:
+            self.restored += 1
+        return persona, turns[::-1]
+
+    # every stored turn of the user, in every channel, for /delete
+    async def delete_user(self, user_id: int) -> int:
+        if self.writer.pending(lambda record: record["user"] == user_id):
+            await self.writer.flush()
+        return await self.repository.delete_conversations(user_id)
+
+    def stats(self) -> dict:
+        return {**self.writer.stats(), "restored": self.restored}
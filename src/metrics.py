@@ -0,0 +1,157 @@
+"""
+Module responsible for the bot's own latency and load metrics
+
+Stages are timed into fixed-bucket histograms and errors are counted by stage
+and type. Gauges such as the queue depth are only read when the metrics are
+rendered, so recording stays a few dictionary lookups on the hot path.
+
+Everything is served in the Prometheus text format on METRICS_HOST:METRICS_PORT
+when METRICS_PORT is set, and summarised by the /metrics slash command.
+"""
+import os
+import time
+import asyncio
+import contextlib
+from bisect import bisect_left
+
+from src.log import logger
+
+PREFIX = "ourgpt"
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+class Histogram:
+    def __init__(self, buckets: tuple = DEFAULT_BUCKETS) -> None:
+        self.buckets = buckets
+        # counts[i] is the number of observations that fell in (buckets[i-1], buckets[i]], the last is +Inf
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    # upper bound of the bucket holding the q-th quantile
+    def quantile(self, q: float) -> float:
+        if not self.count:
+            return 0.0
+        rank, seen = q * self.count, 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+
+def _labels(labels: tuple) -> str:
+    return ",".join(f'{name}="{value}"' for name, value in labels)
+
+
+class Registry:
+    def __init__(self) -> None:
+        self.histograms: dict[tuple, Histogram] = {}
+        self.counters: dict[str, dict[tuple, float]] = {}
+        self.gauges: dict[str, object] = {}
+
+    def observe(self, stage: str, seconds: float, **labels) -> None:
+        key = (("stage", stage),) + tuple(sorted(labels.items()))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram()
+        histogram.observe(seconds)
+
+    def inc(self, name: str, amount: float = 1, **labels) -> None:
+        family = self.counters.setdefault(name, {})
+        key = tuple(sorted(labels.items()))
+        family[key] = family.get(key, 0) + amount
+
+    def error(self, stage: str, error: BaseException) -> None:
+        self.inc("errors_total", stage=stage, type=type(error).__name__)
+
+    # fn is only called when the metrics are rendered
+    def gauge(self, name: str, fn) -> None:
+        self.gauges[name] = fn
+
+    @contextlib.contextmanager
+    def time(self, stage: str, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        except Exception as e:
+            self.error(stage, e)
+            raise
+        finally:
+            self.observe(stage, time.perf_counter() - started, **labels)
+
+    def render(self) -> str:
+        lines = [f"# TYPE {PREFIX}_stage_seconds histogram"]
+        for labels, histogram in self.histograms.items():
+            cumulative = 0
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                cumulative += count
+                lines.append(f'{PREFIX}_stage_seconds_bucket{{{_labels(labels)},le="{bound}"}} {cumulative}')
+            lines.append(f'{PREFIX}_stage_seconds_bucket{{{_labels(labels)},le="+Inf"}} {histogram.count}')
+            lines.append(f"{PREFIX}_stage_seconds_sum{{{_labels(labels)}}} {histogram.sum}")
+            lines.append(f"{PREFIX}_stage_seconds_count{{{_labels(labels)}}} {histogram.count}")
+        for name, family in self.counters.items():
+            lines.append(f"# TYPE {PREFIX}_{name} counter")
+            lines += [f"{PREFIX}_{name}{{{_labels(labels)}}} {value}" for labels, value in family.items()]
+        for name, fn in self.gauges.items():
+            try:
+                value = fn()
+            except Exception as e:
+                logger.warning(f"Error while reading gauge {name}: {e}")
+                continue
+            lines.append(f"# TYPE {PREFIX}_{name} gauge")
+            lines.append(f"{PREFIX}_{name} {value}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> str:
+        lines = [f"{'stage':<28} {'count':>7} {'p50':>8} {'p95':>8} {'p99':>8}"]
+        for labels, histogram in sorted(self.histograms.items()):
+            name = " ".join(str(value) for _, value in labels)
+            lines.append(
+                f"{name[:28]:<28} {histogram.count:>7} {histogram.quantile(0.5):>7}s "
+                f"{histogram.quantile(0.95):>7}s {histogram.quantile(0.99):>7}s")
+        for name, fn in self.gauges.items():
+            with contextlib.suppress(Exception):
+                lines.append(f"{name}: {fn()}")
+        for labels, value in self.counters.get("errors_total", {}).items():
+            lines.append(f"errors {_labels(labels)}: {value:g}")
+        return "\n".join(lines)
+
+
+metrics = Registry()
+
+
+async def _handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), 5)
+        # skip the headers, nothing in them matters here
+        while (await asyncio.wait_for(reader.readline(), 5)) not in (b"\r\n", b"\n", b""):
+            pass
+        parts = request_line.split()
+        if len(parts) > 1 and parts[1] == b"/metrics":
+            status, body = "200 OK", metrics.render().encode("utf-8")
+        else:
+            status, body = "404 Not Found", b"not found\n"
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode("utf-8") + body)
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve():
+    port = os.getenv("METRICS_PORT")
+    if not port:
+        return None
+    host = os.getenv("METRICS_HOST", "127.0.0.1")
+    server = await asyncio.start_server(_handle, host, int(port))
+    logger.info(f"Serving metrics on http://{host}:{port}/metrics")
+    return server
@@ -0,0 +1,127 @@
+"""
+Module responsible for the database schema
+
+Migrations run once each, in order, at startup. The ones applied so far are
+recorded in the `migrations` collection, so a restart only runs new ones. A
+migration that fails is logged and tried again on the next start, and the
+ones after it wait for it.
+
+Migrations never delete data on their own. When several documents share a
+username, the unique index migration logs them and fails until they are
+removed by hand, or MIGRATE_DEDUPE_USERNAMES=True lets it keep only the newest
+registration of each username.
+
+Retention is not a migration. `interactions` follows
+INTERACTION_RETENTION_DAYS and `conversations` CONVERSATION_RETENTION_DAYS
+every start: 0 keeps records forever, anything else lets MongoDB's TTL
+monitor delete records older than that.
+"""
+import os
+from datetime import datetime
+
+from pymongo import ASCENDING, DESCENDING
+from pymongo.errors import DuplicateKeyError
+
+from src.log import logger
+
+RETENTION_INDEX = "timestamp_ttl"
+
+
+def _unique_usernames(db) -> None:
+    preferences = db["preferences"]
+    # the find-then-insert check in /register could be raced past, leaving several documents for one username
+    seen, duplicates = set(), {}
+    for document in preferences.find({}, {"username": 1}, sort=[("_id", DESCENDING)]):
+        username = document.get("username")
+        if username in seen:
+            duplicates.setdefault(username, []).append(document["_id"])
+        seen.add(username)
+    if duplicates:
+        # deleting registrations is left to the operator, unless they opted in to keeping only the newest one
+        if os.getenv("MIGRATE_DEDUPE_USERNAMES") != "True":
+            for username, ids in duplicates.items():
+                logger.warning(f"Username {username!r} has {len(ids)} older duplicate registrations: {ids}")
+            raise RuntimeError(
+                f"{len(duplicates)} usernames are registered more than once, remove the duplicates "
+                "or set MIGRATE_DEDUPE_USERNAMES=True to keep only the newest registration of each")
+        ids = [_id for ids in duplicates.values() for _id in ids]
+        preferences.delete_many({"_id": {"$in": ids}})
+        logger.warning(f"Removed {len(ids)} duplicate registrations of {len(duplicates)} usernames")
+    preferences.create_index([("username", ASCENDING)], unique=True, name="username_unique")
+
+
+def _backfill_timestamps(db) -> None:
+    interactions = db["interactions"]
+    # records logged before they carried a timestamp, their ObjectId holds the time they were inserted
+    interactions.update_many({"timestamp": {"$exists": False}}, [{"$set": {"timestamp": {"$toDate": "$_id"}}}])
+
+
+def _interaction_indexes(db) -> None:
+    # a user's interactions, newest first
+    db["interactions"].create_index([("username", ASCENDING), ("timestamp", DESCENDING)], name="username_timestamp")
+
+
+def _conversation_indexes(db) -> None:
+    # a conversation's records newest first, the ObjectId keeps the order they were written in
+    db["conversations"].create_index(
+        [("guild", ASCENDING), ("channel", ASCENDING), ("user", ASCENDING), ("_id", DESCENDING)], name="conversation_turns")
+
+
+MIGRATIONS = [
+    (1, "unique usernames", _unique_usernames),
+    (2, "backfill interaction timestamps", _backfill_timestamps),
+    (3, "interaction indexes", _interaction_indexes),
+    (4, "conversation indexes", _conversation_indexes),
+]
+
+# collection -> setting and default number of days its records are kept
+RETENTION = {
+    "interactions": ("INTERACTION_RETENTION_DAYS", 90),
+    "conversations": ("CONVERSATION_RETENTION_DAYS", 30),
+}
+
+
+def _ensure_retention(db, name: str) -> None:
+    variable, default = RETENTION[name]
+    days = float(os.getenv(variable, default))
+    collection = db[name]
+    current = collection.index_information().get(RETENTION_INDEX)
+    if not days:
+        if current:
+            collection.drop_index(RETENTION_INDEX)
+            logger.info(f"Dropped the {name} retention index")
+        return
+
+    seconds = int(days * 86400)
+    if current is None:
+        collection.create_index([("timestamp", ASCENDING)], name=RETENTION_INDEX, expireAfterSeconds=seconds)
+        logger.info(f"{name.capitalize()} are now kept for {days:g} days")
+    elif current.get("expireAfterSeconds") != seconds:
+        # changed in place, no need to rebuild the index
+        db.command("collMod", name, index={"name": RETENTION_INDEX, "expireAfterSeconds": seconds})
+        logger.info(f"{name.capitalize()} are now kept for {days:g} days")
+
+
+# blocking, meant to run on the database executor
+def apply(db) -> None:
+    applied = {document["_id"] for document in db["migrations"].find({}, {"_id": 1})}
+    for version, name, migrate in MIGRATIONS:
+        if version in applied:
+            continue
+        try:
+            migrate(db)
+        except Exception as e:
+            logger.exception(f"Error while applying migration {version} ({name}): {e}")
+            break
+        try:
+            db["migrations"].insert_one({"_id": version, "name": name, "applied_at": datetime.utcnow()})
+        except DuplicateKeyError:
+            # another shard process got there at the same time, every migration is safe to run twice
+            continue
+        logger.info(f"Applied migration {version} ({name})")
+
+    for name in RETENTION:
+        try:
+            _ensure_retention(db, name)
+        except Exception as e:
+            logger.exception(f"Error while setting the {name} retention: {e}")
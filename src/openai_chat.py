@@ -0,0 +1,152 @@
+"""
+Module responsible for the native asyncio backend of the OFFICIAL chat model
+
+Every chatbot shares one aiohttp connection pool with keep-alive, and a
+semaphore caps how many completions run at once. The chatbot mirrors the parts
+of revChatGPT.V3.Chatbot the bot relies on, so the two are interchangeable.
+OPENAI_BASE_URL points it at any OpenAI compatible server, such as a local
+stand-in for tests.
+"""
+import os
+import json
+import asyncio
+
+import aiohttp
+
+from src.log import logger
+from src.context import count_conversation
+
+
+class OpenAIChatError(Exception):
+    pass
+
+
+_session: aiohttp.ClientSession = None
+_semaphore = asyncio.Semaphore(int(os.getenv("OPENAI_CONCURRENCY", 16)))
+
+
+def http_session() -> aiohttp.ClientSession:
+    global _session
+    if _session is None or _session.closed:
+        _session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=int(os.getenv("OPENAI_MAX_CONNECTIONS", 64)),
+                keepalive_timeout=float(os.getenv("OPENAI_KEEPALIVE", 60)),
+            ),
+            timeout=aiohttp.ClientTimeout(
+                total=float(os.getenv("OPENAI_TIMEOUT", 120)),
+                connect=float(os.getenv("OPENAI_CONNECT_TIMEOUT", 10)),
+            ),
+        )
+    return _session
+
+
+# opens a connection, TLS included, so the first completion does not pay for it
+async def warm_up(base_url: str = None) -> None:
+    base_url = (base_url or os.getenv("OPENAI_BASE_URL", "https://api.openai.com/v1")).rstrip("/")
+    async with http_session().head(base_url) as response:
+        await response.read()
+
+
+async def close() -> None:
+    if _session is not None and not _session.closed:
+        await _session.close()
+
+
+class OpenAIChatbot:
+    """Chat completions over the shared connection pool"""
+
+    def __init__(
+        self,
+        api_key: str,
+        engine: str = "gpt-3.5-turbo",
+        system_prompt: str = "You are ChatGPT, a large language model trained by OpenAI. Respond conversationally",
+        base_url: str = None,
+        temperature: float = 0.5,
+        truncate_limit: int = None,
+    ) -> None:
+        self.api_key = api_key
+        self.engine = engine or "gpt-3.5-turbo"
+        self.system_prompt = system_prompt
+        self.base_url = (base_url or os.getenv("OPENAI_BASE_URL", "https://api.openai.com/v1")).rstrip("/")
+        self.temperature = temperature
+        self.truncate_limit = truncate_limit or (6500 if "gpt-4" in self.engine else 3500)
+        self.conversation: dict[str, list[dict]] = {}
+        self.reset()
+
+    def add_to_conversation(self, message: str, role: str, convo_id: str = "default") -> None:
+        self.conversation[convo_id].append({"role": role, "content": message})
+
+    def reset(self, convo_id: str = "default", system_prompt: str = None) -> None:
+        self.conversation[convo_id] = [{"role": "system", "content": system_prompt or self.system_prompt}]
+
+    def rollback(self, n: int = 1, convo_id: str = "default") -> None:
+        for _ in range(n):
+            self.conversation[convo_id].pop()
+
+    # last resort behind src/context.py, drops the oldest messages after the system prompt
+    def _truncate(self, convo_id: str) -> None:
+        turns = self.conversation[convo_id]
+        while len(turns) > 2 and count_conversation(turns) > self.truncate_limit:
+            del turns[1]
+
+    def _request(self, convo_id: str, stream: bool):
+        return http_session().post(
+            f"{self.base_url}/chat/completions",
+            headers={"Authorization": f"Bearer {self.api_key}"},
+            json={
+                "model": self.engine,
+                "messages": self.conversation[convo_id],
+                "temperature": self.temperature,
+                "stream": stream,
+            },
+        )
+
+    def _start(self, prompt: str, role: str, convo_id: str) -> None:
+        if convo_id not in self.conversation:
+            self.reset(convo_id=convo_id)
+        self.add_to_conversation(prompt, role, convo_id=convo_id)
+        self._truncate(convo_id)
+
+    async def ask(self, prompt: str, role: str = "user", convo_id: str = "default") -> str:
+        self._start(prompt, role, convo_id)
+        try:
+            async with _semaphore, self._request(convo_id, stream=False) as response:
+                if response.status != 200:
+                    raise OpenAIChatError(f"{response.status} {await response.text()}")
+                data = await response.json()
+        except Exception:
+            # drop the unanswered prompt so the history stays well formed
+            self.rollback(convo_id=convo_id)
+            raise
+        answer = data["choices"][0]["message"]["content"]
+        self.add_to_conversation(answer, "assistant", convo_id=convo_id)
+        return answer
+
+    async def ask_stream_async(self, prompt: str, role: str = "user", convo_id: str = "default"):
+        self._start(prompt, role, convo_id)
+        answer = ""
+        try:
+            async with _semaphore, self._request(convo_id, stream=True) as response:
+                if response.status != 200:
+                    raise OpenAIChatError(f"{response.status} {await response.text()}")
+                async for line in response.content:
+                    line = line.decode("utf-8").strip()
+                    if not line.startswith("data: "):
+                        continue
+                    data = line[len("data: "):]
+                    if data == "[DONE]":
+                        break
+                    chunk = json.loads(data)
+                    if "error" in chunk:
+                        raise OpenAIChatError(f"{chunk['error']}")
+                    choices = chunk.get("choices")
+                    content = choices[0].get("delta", {}).get("content") if choices else None
+                    if content:
+                        answer += content
+                        yield content
+        except Exception:
+            self.rollback(convo_id=convo_id)
+            logger.warning(f"Streamed completion failed after {len(answer)} characters")
+            raise
+        self.add_to_conversation(answer, "assistant", convo_id=convo_id)
@@ -0,0 +1,141 @@
+"""
+Module responsible for sending replies to Discord
+
+Every reply is queued per channel. A channel's messages go out one at a time
+and in order, but different channels are served concurrently, so one slow or
+rate-limited channel does not hold up the others. Callers queue all parts of
+a reply at once instead of waiting for each in turn, and small text parts of
+the same reply queued back to back are sent as one message.
+
+discord.py already tracks Discord's rate-limit buckets, waits out short 429s
+and retries server errors by itself; the 429s are counted from its log. Only
+a rate limit that still reaches us is retried here, holding back only the
+channel it came from. Server errors are not, the message may already have
+been posted, and neither are uploads, discord.py closes their files after the
+first attempt.
+"""
+import os
+import asyncio
+import logging
+from collections import deque
+
+import discord
+
+from src.log import logger
+from src.metrics import metrics
+from utils.message_utils import CHAR_LIMIT
+
+
+class _RateLimitLog(logging.Handler):
+    """Counts the 429s discord.py handles on its own, it only reports them in its log"""
+
+    def emit(self, record: logging.LogRecord) -> None:
+        if record.levelno >= logging.WARNING and "rate limit" in record.getMessage():
+            metrics.inc("discord_rate_limited_total", source=record.name)
+
+
+logging.getLogger("discord").addHandler(_RateLimitLog())
+
+
+class OutboundMessage:
+    def __init__(self, send, content: str, kwargs: dict, reply) -> None:
+        self.send = send
+        self.content = content
+        self.kwargs = kwargs
+        # only parts of the same reply are merged, never messages meant for different users
+        self.reply = reply if content is not None and not kwargs else None
+        self.future = asyncio.get_running_loop().create_future()
+
+
+class Outbox:
+    """Per-channel send queues, each drained by its own task while it has anything queued"""
+
+    def __init__(self) -> None:
+        self.max_retries = int(os.getenv("OUTBOUND_MAX_RETRIES", 3))
+        self.coalesce = os.getenv("OUTBOUND_COALESCE", "True") == "True"
+        self._queues: dict[int, deque] = {}
+        self._tasks: dict[int, asyncio.Task] = {}
+        self.sent = 0
+        self.coalesced = 0
+        self.retries = 0
+        self.failed = 0
+
+    # queue a message for the channel and return a future for the sent discord.Message
+    # send is the coroutine function that posts it, e.g. channel.send or interaction.followup.send
+    # parts submitted with the same `reply` object may be sent together as one message
+    def submit(self, channel_id: int, send, content: str = None, reply=None, **kwargs) -> asyncio.Future:
+        item = OutboundMessage(send, content, kwargs, reply if self.coalesce else None)
+        self._queues.setdefault(channel_id, deque()).append(item)
+        if channel_id not in self._tasks:
+            self._tasks[channel_id] = asyncio.create_task(self._drain(channel_id))
+        return item.future
+
+    async def send(self, channel_id: int, send, content: str = None, reply=None, **kwargs):
+        return await self.submit(channel_id, send, content, reply, **kwargs)
+
+    async def _drain(self, channel_id: int) -> None:
+        queue, items = self._queues[channel_id], []
+        try:
+            while queue:
+                items = [queue.popleft()]
+                content = items[0].content
+                # fold in the rest of the same reply queued right behind it while it fits
+                while (items[0].reply is not None and queue and queue[0].reply is items[0].reply
+                       and queue[0].send == items[0].send and len(content) + 1 + len(queue[0].content) <= CHAR_LIMIT):
+                    items.append(queue.popleft())
+                    content = f"{content}\n{items[-1].content}"
+                self.coalesced += len(items) - 1
+
+                try:
+                    sent = await self._send(items[0].send, content, items[0].kwargs)
+                except Exception as e:
+                    self.failed += 1
+                    for item in items:
+                        if not item.future.done():
+                            item.future.set_exception(e)
+                    continue
+                self.sent += 1
+                for item in items:
+                    if not item.future.done():
+                        item.future.set_result(sent)
+        finally:
+            del self._tasks[channel_id]
+            del self._queues[channel_id]
+            # only left over when the task was cancelled, do not leave the callers waiting
+            for item in [*items, *queue]:
+                if not item.future.done():
+                    item.future.cancel()
+
+    async def _send(self, send, content: str, kwargs: dict):
+        # the files of an upload are closed once discord.py has tried it
+        retries = 0 if "file" in kwargs or "files" in kwargs else self.max_retries
+        for attempt in range(retries + 1):
+            try:
+                return await send(content, **kwargs)
+            except discord.RateLimited as e:
+                if attempt == retries:
+                    raise
+                reason, delay = "429", e.retry_after
+            except discord.HTTPException as e:
+                # a 429 was rejected, so it was not posted; a 5xx may have been, and discord.py retried it already
+                if attempt == retries or e.status != 429:
+                    raise
+                reason, delay = "429", 2 ** attempt
+            self.retries += 1
+            metrics.inc("discord_retries_total", reason=reason)
+            logger.warning(f"Discord send failed with {reason}, retrying in {delay:.1f}s")
+            # only this channel waits, the other channels' tasks carry on
+            await asyncio.sleep(delay)
+
+    def depth(self) -> int:
+        return sum(len(queue) for queue in self._queues.values())
+
+    def stats(self) -> dict:
+        return {
+            "queued": self.depth(),
+            "channels": len(self._tasks),
+            "sent": self.sent,
+            "coalesced": self.coalesced,
+            "retries": self.retries,
+            "failed": self.failed,
+        }
@@ -0,0 +1,85 @@
+"""
+Module responsible for answering repeated prompts without calling the model again
+
+Answers are keyed on the chat model, the engine, the conversation so far (which
+carries the system prompt or persona) and the normalised prompt, so the same
+question only hits the cache when it was asked in the same context. The
+near-duplicate mode also matches prompts whose words mostly overlap.
+"""
+import os
+import re
+import json
+import hashlib
+
+from src.cache import LRUCache
+
+
+def normalise_prompt(prompt: str) -> str:
+    return " ".join(prompt.lower().split()).rstrip(" ?!.")
+
+
+# UNOFFICIAL keeps its history server side, the conversation and parent ids stand in for it
+def context_fingerprint(chatbot) -> str:
+    conversation = getattr(chatbot, "conversation", None)
+    if isinstance(conversation, dict):
+        context = json.dumps(conversation.get("default", []))
+    else:
+        context = f"{getattr(chatbot, 'conversation_id', None)}:{getattr(chatbot, 'parent_id', None)}"
+    return hashlib.sha1(context.encode("utf-8")).hexdigest()
+
+
+def request_key(client, session, prompt: str) -> tuple:
+    settings = client.settings(session.key[0])
+    return (settings.chat_model, settings.openAI_gpt_engine, context_fingerprint(session.chatbot), normalise_prompt(prompt))
+
+
+def _words(prompt: str) -> frozenset:
+    return frozenset(re.findall(r"\w+", prompt))
+
+
+class ResponseCache:
+    """Exact, and optionally near-duplicate, lookup of earlier answers"""
+
+    def __init__(self, maxsize: int = None, ttl: float = None, similarity: float = None) -> None:
+        self._answers = LRUCache(
+            maxsize=maxsize or int(os.getenv("RESPONSE_CACHE_SIZE", 1024)),
+            ttl=ttl or float(os.getenv("RESPONSE_CACHE_TTL", 3600)),
+        )
+        # 0 turns the near-duplicate lookup off, otherwise the minimum word overlap (Jaccard) to count as the same prompt
+        self.similarity = similarity if similarity is not None else float(os.getenv("RESPONSE_CACHE_SIMILARITY", 0))
+        self.saved_seconds = 0.0
+
+    def get(self, key: tuple):
+        entry = self._answers.get(key)
+        if entry is None and self.similarity:
+            entry = self._nearest(key)
+        if entry is None:
+            return None
+        answer, latency = entry
+        self.saved_seconds += latency
+        return answer
+
+    def set(self, key: tuple, answer: str, latency: float) -> None:
+        self._answers.set(key, (answer, latency))
+
+    def _nearest(self, key: tuple):
+        *context, prompt = key
+        words = _words(prompt)
+        if not words:
+            return None
+        best, best_score = None, self.similarity
+        for (*other_context, other_prompt), entry in self._answers.items():
+            if other_context != context:
+                continue
+            other_words = _words(other_prompt)
+            score = len(words & other_words) / len(words | other_words)
+            if score >= best_score:
+                best, best_score = entry, score
+        if best is not None:
+            # counted as a hit rather than the miss the exact lookup recorded
+            self._answers.misses -= 1
+            self._answers.hits += 1
+        return best
+
+    def stats(self) -> dict:
+        return {**self._answers.stats(), "saved_seconds": self.saved_seconds}
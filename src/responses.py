@@ -1,21 +1,49 @@
+import asyncio
+
 from src import personas
-from src.log import logger
 from asgiref.sync import sync_to_async
 
-async def official_handle_response(message, client) -> str:
-    return await sync_to_async(client.chatbot.ask)(message)
+# thread_sensitive=False so conversations are not all serialised on one shared thread,
+# each session's lock already stops a single chatbot from being asked twice at once
+# on_update, when given, is awaited with the answer so far every time more of it arrives
+async def official_handle_response(message, chatbot, on_update=None) -> str:
+    if on_update is None:
+        if asyncio.iscoroutinefunction(chatbot.ask):
+            return await chatbot.ask(message)
+        return await sync_to_async(chatbot.ask, thread_sensitive=False)(message)
+    responseMessage = ""
+    async for chunk in chatbot.ask_stream_async(message):
+        responseMessage += chunk
+        await on_update(responseMessage)
+    return responseMessage
 
-async def unofficial_handle_response(message, client) -> str:
-    async for response in client.chatbot.ask(message):
+async def unofficial_handle_response(message, chatbot, on_update=None) -> str:
+    async for response in chatbot.ask(message):
         responseMessage = response["message"]
+        if on_update is not None:
+            await on_update(responseMessage)
     return responseMessage
 
 
-# resets conversation and asks chatGPT the prompt for a persona
-async def switch_persona(persona, client) -> None:
-    if client.chat_model ==  "UNOFFICIAL":
-        client.chatbot.reset_chat()
-        async for _ in client.chatbot.ask(personas.PERSONAS.get(persona)):
-            pass
-    elif client.chat_model == "OFFICIAL":
-        client.chatbot = client.get_chatbot_model(prompt=personas.PERSONAS.get(persona))
+# the prompt sent for /chat, a registered user's preferences go in front of their question
+def preference_prompt(user, message: str) -> str:
+    preferences = user.get('preferences', []) if user else None
+    if not preferences:
+        return message
+    preferences_str = ", ".join(preferences)  # Convert list to string
+    return f"These are my preferences: {preferences_str} I ask: {message}"
+
+
+# resets a conversation and asks chatGPT the prompt for a persona
+async def switch_persona(persona, client, session) -> None:
+    chat_model = client.settings(session.key[0]).chat_model
+    async with session.lock:
+        if chat_model ==  "UNOFFICIAL":
+            session.chatbot.reset_chat()
+            async for _ in session.chatbot.ask(personas.PERSONAS.get(persona)):
+                pass
+            session.primed = True
+        elif chat_model == "OFFICIAL":
+            session.chatbot = client.get_chatbot_model(prompt=personas.PERSONAS.get(persona), guild_id=session.key[0])
+        session.persona = persona
+        client.forget(session.key, persona)
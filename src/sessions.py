@@ -0,0 +1,146 @@
+"""
+Module responsible for keeping one conversation per (guild, channel, user)
+
+Chatbots are built lazily on the first message of a conversation and idle
+conversations are evicted by LRU and TTL once the configured caps are hit.
+"""
+import os
+import time
+import asyncio
+from collections import OrderedDict
+
+from src.log import logger
+
+
+class Session:
+    """A single conversation and the chatbot holding its history"""
+
+    def __init__(self, key: tuple, chatbot) -> None:
+        self.key = key
+        self.chatbot = chatbot
+        self.persona = "standard"
+        # UNOFFICIAL has no system prompt, the starting prompt goes out with the first message
+        self.primed = False
+        # set once the history stored for this conversation has been replayed, see src/history.py
+        self.restored = False
+        # held while the chatbot is answering so a conversation never runs twice at once
+        self.lock = asyncio.Lock()
+        self.last_used = time.monotonic()
+        # size when last measured by SessionManager.resize
+        self.bytes = 0
+
+    def record_turn(self, prompt: str, answer: str) -> None:
+        # keeps the local history in step when an answer did not come from the chatbot itself
+        if isinstance(getattr(self.chatbot, "conversation", None), dict):
+            self.chatbot.add_to_conversation(prompt, "user")
+            self.chatbot.add_to_conversation(answer, "assistant")
+
+    def size(self) -> int:
+        # rough footprint of the history held in memory, UNOFFICIAL keeps its history server side
+        conversation = getattr(self.chatbot, "conversation", None)
+        if not isinstance(conversation, dict):
+            return 0
+        return sum(len(turn["content"] or "") for turns in conversation.values() for turn in turns)
+
+
+class SessionManager:
+    """LRU + TTL store of sessions"""
+
+    def __init__(self, factory, max_sessions: int = None, ttl: float = None, max_bytes: int = None) -> None:
+        self.factory = factory
+        self.max_sessions = max_sessions or int(os.getenv("SESSION_MAX_COUNT", 1000))
+        self.ttl = ttl or float(os.getenv("SESSION_TTL", 3600))
+        # 0 disables the memory cap
+        self.max_bytes = max_bytes if max_bytes is not None else int(os.getenv("SESSION_MAX_BYTES", 0))
+        self._sessions: OrderedDict[tuple, Session] = OrderedDict()
+        # sum of the sizes last measured by resize, only kept up to date with a memory cap
+        self._bytes = 0
+        self.evicted = 0
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def get(self, key: tuple) -> Session:
+        self.prune()
+        session = self._sessions.get(key)
+        if session is None:
+            session = Session(key, self.factory(key))
+            self._sessions[key] = session
+        else:
+            self._sessions.move_to_end(key)
+        session.last_used = time.monotonic()
+        if self.max_bytes > 0:
+            self.resize(session)
+        else:
+            self._evict(keep=key)
+        return session
+
+    # the session if there is one, without creating it
+    def peek(self, key: tuple):
+        return self._sessions.get(key)
+
+    # measures a session again after its history changed, only that session is walked
+    def resize(self, session: Session) -> None:
+        if self.max_bytes <= 0 or self._sessions.get(session.key) is not session:
+            return
+        size = session.size()
+        self._bytes += size - session.bytes
+        session.bytes = size
+        self._evict(keep=session.key)
+
+    def _remove(self, key: tuple) -> None:
+        session = self._sessions.pop(key, None)
+        if session is not None:
+            self._bytes -= session.bytes
+
+    def drop(self, key: tuple) -> None:
+        self._remove(key)
+
+    def clear(self) -> None:
+        self._sessions.clear()
+        self._bytes = 0
+
+    # guild_id is None for direct messages
+    def drop_guild(self, guild_id) -> None:
+        for key in [key for key in self._sessions if key[0] == guild_id]:
+            self._remove(key)
+
+    def drop_user(self, user_id) -> None:
+        for key in [key for key in self._sessions if key[2] == user_id]:
+            self._remove(key)
+
+    def prune(self) -> None:
+        deadline = time.monotonic() - self.ttl
+        # oldest first, stop at the first session that is still fresh
+        expired = []
+        for key, session in self._sessions.items():
+            if session.last_used > deadline:
+                break
+            if not session.lock.locked():
+                expired.append(key)
+        for key in expired:
+            self._remove(key)
+        self.evicted += len(expired)
+
+    def _over_cap(self, count: int, size: int) -> bool:
+        return count > self.max_sessions or (self.max_bytes > 0 and size > self.max_bytes)
+
+    def _evict(self, keep: tuple) -> None:
+        count, size = len(self._sessions), self._bytes
+        evicted = []
+        # least recently used first, stop as soon as the rest fits
+        for key, session in self._sessions.items():
+            if not self._over_cap(count, size):
+                break
+            # never evict the conversation being served or one that is mid-answer
+            if key == keep or session.lock.locked():
+                continue
+            evicted.append(key)
+            count, size = count - 1, size - session.bytes
+        for key in evicted:
+            self._remove(key)
+            self.evicted += 1
+            logger.info(f"Evicted idle session {key}")
+
+    def stats(self) -> dict:
+        return {"sessions": len(self._sessions), "evicted": self.evicted}
@@ -0,0 +1,45 @@
+"""
+Module responsible for coalescing identical requests that are in flight at the same time
+
+The first caller with a key runs the call, anyone arriving with the same key
+before it finishes waits for that result instead of making a call of their own.
+"""
+import asyncio
+
+
+class SingleFlight:
+    """Shares one execution between overlapping calls with the same key"""
+
+    def __init__(self) -> None:
+        self._calls: dict = {}
+        self.saved = 0
+
+    # returns the result and whether it came from somebody else's call
+    async def do(self, key, fn) -> tuple:
+        future = self._calls.get(key)
+        if future is not None:
+            self.saved += 1
+            # shielded so a follower giving up does not cancel the leader's call
+            return await asyncio.shield(future), True
+
+        future = self._calls[key] = asyncio.get_running_loop().create_future()
+        try:
+            result = await fn()
+        except asyncio.CancelledError:
+            # followers get an ordinary error, a CancelledError would slip past their `except Exception`
+            future.set_exception(RuntimeError("leader cancelled"))
+            future.exception()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # mark it retrieved, nobody may be waiting
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+            return result, False
+        finally:
+            del self._calls[key]
+
+    def __len__(self) -> int:
+        return len(self._calls)
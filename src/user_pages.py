@@ -0,0 +1,88 @@
+"""
+Module responsible for paging through /list_users
+
+Every page is a single query for USER_PAGE_SIZE users that continues from the
+last (or first) user already shown, so turning a page costs the same however
+many users are registered and only one page is ever held in memory. Only the
+`page` option of /list_users skips over users, to reach the first page shown.
+"""
+import os
+
+import discord
+
+from utils.message_utils import user_table
+
+# a page has to fit in one Discord message
+PAGE_SIZE = max(1, min(int(os.getenv("USER_PAGE_SIZE", 20)), 25))
+
+
+class UserPages(discord.ui.View):
+    """Previous/Next buttons under a /list_users reply, only the user who asked can press them"""
+
+    def __init__(self, repository, owner_id: int, sort: str = "username", descending: bool = False,
+                 prefix: str = None, page_size: int = PAGE_SIZE, timeout: float = 180) -> None:
+        super().__init__(timeout=timeout)
+        self.repository = repository
+        self.owner_id = owner_id
+        self.query = {"sort": sort, "descending": descending, "prefix": prefix}
+        self.page_size = page_size
+        self.page = 1
+        self.users: list[dict] = []
+        # the latest interaction, used to disable the buttons once they time out
+        self.interaction = None
+
+    def _key(self, user: dict):
+        return user["username"] if self.query["sort"] == "username" else user["_id"]
+
+    def _show(self, users: list[dict], more_before: bool, more_after: bool) -> None:
+        self.users = users
+        self.previous.disabled = not more_before
+        self.next.disabled = not more_after
+
+    def content(self) -> str:
+        if not self.users:
+            return f"No registered users on page {self.page}."
+        return f"{user_table(self.users)}\nPage {self.page}"
+
+    # one extra user is fetched with every page to know whether there is another one after it
+    async def load(self, page: int = 1) -> None:
+        users = await self.repository.list_users(self.page_size + 1, skip=(page - 1) * self.page_size, **self.query)
+        self.page = page
+        self._show(users[:self.page_size], more_before=page > 1, more_after=len(users) > self.page_size)
+
+    async def interaction_check(self, interaction: discord.Interaction) -> bool:
+        if interaction.user.id != self.owner_id:
+            await interaction.response.send_message("Use /list_users to browse the users yourself.", ephemeral=True)
+            return False
+        return True
+
+    @discord.ui.button(label="Previous", style=discord.ButtonStyle.secondary)
+    async def previous(self, interaction: discord.Interaction, button: discord.ui.Button) -> None:
+        self.interaction = interaction
+        if not self.users:
+            # `page` pointed past the last user, there is no key to continue from
+            await self.load(self.page - 1)
+            await interaction.response.edit_message(content=self.content(), view=self)
+            return
+        users = await self.repository.list_users(self.page_size + 1, before=self._key(self.users[0]), **self.query)
+        more_before = len(users) > self.page_size
+        # users deleted in the meantime can leave fewer pages before this one than counted
+        self.page = max(self.page - 1, 1) if more_before else 1
+        self._show(users[-self.page_size:], more_before=more_before, more_after=True)
+        await interaction.response.edit_message(content=self.content(), view=self)
+
+    @discord.ui.button(label="Next", style=discord.ButtonStyle.secondary)
+    async def next(self, interaction: discord.Interaction, button: discord.ui.Button) -> None:
+        users = await self.repository.list_users(self.page_size + 1, after=self._key(self.users[-1]), **self.query)
+        self.page += 1
+        self._show(users[:self.page_size], more_before=True, more_after=len(users) > self.page_size)
+        self.interaction = interaction
+        await interaction.response.edit_message(content=self.content(), view=self)
+
+    async def on_timeout(self) -> None:
+        self.previous.disabled = self.next.disabled = True
+        if self.interaction:
+            try:
+                await self.interaction.edit_original_response(view=self)
+            except discord.HTTPException:
+                pass
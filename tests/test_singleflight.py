@@ -0,0 +1,42 @@
+import asyncio
+import unittest
+
+from src.singleflight import SingleFlight
+
+
+class SingleFlightTest(unittest.IsolatedAsyncioTestCase):
+    async def test_follower_shares_the_leaders_result(self):
+        flight = SingleFlight()
+
+        async def call():
+            await asyncio.sleep(0.01)
+            return "answer"
+
+        results = await asyncio.gather(flight.do("key", call), flight.do("key", call))
+        self.assertEqual(results, [("answer", False), ("answer", True)])
+        self.assertEqual(len(flight), 0)
+
+    async def test_cancelled_leader_fails_followers_with_an_ordinary_error(self):
+        flight = SingleFlight()
+        started = asyncio.Event()
+
+        async def call():
+            started.set()
+            await asyncio.sleep(10)
+
+        leader = asyncio.create_task(flight.do("key", call))
+        await started.wait()
+        follower = asyncio.create_task(flight.do("key", call))
+        await asyncio.sleep(0)
+        leader.cancel()
+
+        with self.assertRaises(asyncio.CancelledError):
+            await leader
+        # an Exception, so the follower's worker survives it
+        with self.assertRaisesRegex(RuntimeError, "leader cancelled"):
+            await follower
+        self.assertEqual(len(flight), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,37 +1,85 @@
+import os
 import re
-from discord import Message
-
-async def send_split_message(self, response: str, message: Message, has_followed_up=False):
-    char_limit = 1900
-    if len(response) > char_limit:
-        is_code_block = False
-        parts = response.split("```")
-
-        for i in range(len(parts)):
-            if is_code_block:
-                code_block_chunks = [parts[i][j:j+char_limit] for j in range(0, len(parts[i]), char_limit)]
-                for chunk in code_block_chunks:
-                    if self.is_replying_all == "True" or has_followed_up:
-                        await message.channel.send(f"```{chunk}```")
-                    else:
-                        await message.followup.send(f"```{chunk}```")
-                        has_followed_up = True
-                is_code_block = False
-            else:
-                non_code_chunks = [parts[i][j:j+char_limit] for j in range(0, len(parts[i]), char_limit)]
-                for chunk in non_code_chunks:
-                    if self.is_replying_all == "True" or has_followed_up:
-                        await message.channel.send(chunk)
-                    else:
-                        await message.followup.send(chunk)
-                        has_followed_up = True
-                is_code_block = True
-    else:
-        if self.is_replying_all == "True" or has_followed_up:
-            await message.channel.send(response)
+import asyncio
+from bisect import bisect_left
+from datetime import datetime
+from discord import Interaction, Message
+
+from src.log import logger
+
+FENCE = "```"
+# a fence marker and the language tag that may follow it
+FENCE_RE = re.compile(r"```([\w+#.-]{0,20})")
+# Discord's limit on the length of a single message
+CHAR_LIMIT = 2000
+
+
+# where to end a message that has to fit in text[start:end], and where the next one starts
+def _cut(text: str, start: int, end: int) -> tuple[int, int]:
+    # a paragraph break, unless it would leave the message much shorter than it could be
+    cut = text.rfind("\n\n", start, end)
+    if cut - start >= (end - start) * 3 // 4:
+        return cut, cut + 2
+    for separator in ("\n", " "):
+        cut = text.rfind(separator, start, end)
+        if cut > start:
+            return cut, cut + 1
+    return end, end
+
+
+# packs each message as close to char_limit as it can, breaking at a paragraph, a line or a word.
+# A code block that spans messages is closed and reopened with its language. The text is only
+# searched with str.rfind between cuts, and a finished message depends on nothing after it, so
+# streamed replies are split the same way as the text grows
+def split_message(text: str, char_limit: int = CHAR_LIMIT) -> list[str]:
+    markers = [(m.start(), m.end(), m.group(1)) for m in FENCE_RE.finditer(text)]
+    starts = [start for start, _, _ in markers]
+    chunks, pos, reopen = [], 0, ""
+
+    while len(reopen) + len(text) - pos > char_limit:
+        room = char_limit - len(reopen)
+        for closing in (0, len(FENCE) + 1):
+            cut, after = _cut(text, pos, pos + room - closing)
+            count = bisect_left(starts, cut)
+            if count and markers[count - 1][1] > cut:
+                # never cut through a marker
+                cut = after = markers[count - 1][0]
+                count -= 1
+            # inside a code block when an odd number of markers came before the cut
+            if not count % 2 or closing:
+                break
+        if cut <= pos:
+            cut = after = pos + room - closing
+            count = bisect_left(starts, cut)
+
+        chunk = reopen + text[pos:cut]
+        if count % 2:
+            chunks.append(f"{chunk}\n{FENCE}")
+            reopen = f"{FENCE}{markers[count - 1][2]}\n"
+        else:
+            chunks.append(chunk)
+            reopen = ""
+        pos = after
+
+    chunks.append(reopen + text[pos:])
+    return [chunk for chunk in chunks if chunk.strip()]
+
+
+# replyall messages are answered in their channel, slash commands through their followup
+# every chunk is queued on the client's outbox up front, then awaited together
+async def send_split_message(self, response: str, message: Message, has_followed_up=False, reply=None):
+    has_followed_up = has_followed_up or not isinstance(message, Interaction)
+    # small chunks of this reply may be merged by the outbox, other replies' never are
+    reply = reply or object()
+    sends = []
+    for chunk in split_message(response):
+        if has_followed_up:
+            send = message.channel.send
         else:
-            await message.followup.send(response)
+            send = message.followup.send
             has_followed_up = True
+        sends.append(self.outbox.submit(message.channel.id, send, chunk, reply))
+    await asyncio.gather(*sends)
 
     return has_followed_up
 
@@ -42,9 +90,94 @@ async def send_response_with_images(self, response: dict, message: Message):
 
     split_message_text = re.split(r'\[Image of.*?\]', response_content)
 
+    # queued in order by the outbox, so the parts do not have to wait for each other
+    parts = []
     for i in range(len(split_message_text)):
         if split_message_text[i].strip():
-            await send_split_message(self, split_message_text[i].strip(), message, has_followed_up=True)
+            parts.append(split_message_text[i].strip())
 
         if response_images and i < len(response_images):
-            await send_split_message(self, response_images[i].strip(), message, has_followed_up=True)
\ No newline at end of file
+            parts.append(response_images[i].strip())
+    reply = object()
+    await asyncio.gather(*(send_split_message(self, part, message, has_followed_up=True, reply=reply) for part in parts))
+
+
+# the /list_users table, one line per registered user inside a code block
+def user_table(users) -> str:
+    lines = ["**Registered Users**\n```" + f"{'Username':<20} | {'Register Date':<25}", "-" * 48]
+    for user in users:
+        username = user.get("username", "N/A")
+        register_date = user.get("register_date", "N/A")
+        if isinstance(register_date, datetime):
+            register_date = register_date.strftime('%Y-%m-%d %H:%M:%S')
+        lines.append(f"{username:<20} | {register_date:<25}")
+    return "\n".join(lines) + "\n```"
+
+
+class StreamingResponse:
+    """Posts a reply as soon as the first tokens arrive and edits it while the rest streams in
+
+    Edits are throttled to one every STREAM_EDIT_INTERVAL seconds per reply to stay clear of
+    Discord's edit rate limits, and the reply rolls over into a new message at the character limit.
+    """
+
+    char_limit = CHAR_LIMIT
+
+    def __init__(self, client, message: Message, header: str = "", edit_interval: float = None) -> None:
+        self.client = client
+        self.message = message
+        self.header = header
+        self.edit_interval = edit_interval or float(os.getenv("STREAM_EDIT_INTERVAL", 1.0))
+        self.messages = []
+        self._contents = []
+        self._latest = None
+        # set by finish, wakes the pump from its wait between edits
+        self._done = asyncio.Event()
+        self._task = None
+
+    async def update(self, text: str) -> None:
+        self._latest = text
+        if self._task is None:
+            self._task = asyncio.create_task(self._pump())
+
+    async def finish(self, text: str = None) -> None:
+        self._done.set()
+        if self._task is not None:
+            # only waits for an edit already on its way, never for the rest of the interval
+            await self._task
+        if text is not None:
+            await self._render(text)
+
+    async def _pump(self) -> None:
+        rendered = None
+        while not self._done.is_set():
+            if self._latest != rendered:
+                rendered = self._latest
+                try:
+                    await self._render(rendered)
+                except Exception as e:
+                    # a lost intermediate edit is caught up by the next one or the final render
+                    logger.warning(f"Error while editing a streamed reply: {e}")
+            try:
+                await asyncio.wait_for(self._done.wait(), self.edit_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _render(self, text: str) -> None:
+        for index, part in enumerate(split_message(f"{self.header}{text}", self.char_limit)):
+            if not part.strip():
+                continue
+            if index < len(self.messages):
+                if self._contents[index] != part:
+                    await self.messages[index].edit(content=part)
+                    self._contents[index] = part
+            else:
+                self.messages.append(await self._send(part))
+                self._contents.append(part)
+
+    # the message is edited afterwards, so it is sent without a reply to be merged with
+    async def _send(self, content: str):
+        outbox, channel_id = self.client.outbox, self.message.channel.id
+        if self.messages or not isinstance(self.message, Interaction):
+            return await outbox.send(channel_id, self.message.channel.send, content)
+        return await outbox.send(channel_id, self.message.followup.send, content, wait=True)